@@ -0,0 +1,26 @@
+import pylion as pl
+import numpy as np
+import os
+import tempfile
+import time
+
+# time to write the lammps input files of a simulation for a few cloud sizes,
+# which is what a sweep of many small simulations pays on top of lammps
+repeats = 20
+
+os.chdir(tempfile.mkdtemp())
+for number in [10, 10**3, 10**5]:
+    positions = np.random.default_rng(0).uniform(-1e-4, 1e-4, (number, 3))
+
+    times = []
+    for _ in range(repeats):
+        s = pl.Simulation('renderbenchmark')
+        s.append(pl.placeions({'mass': 40, 'charge': 1}, positions))
+        s.append(pl.langevinbath(0, 1e-5))
+        s.append(pl.evolve(1e4))
+
+        start = time.perf_counter()
+        s._writeinputfile()
+        times.append(time.perf_counter() - start)
+
+    print(f'{number:>6d} ions: {1e3 * min(times):8.2f} ms per simulation')
@@ -1,5 +1,7 @@
-from .pylion import Simulation, __version__
+from .pylion import Simulation, SimulationRun, __version__
 from .functions import *
+from .sweep import sweep
+from .cache import ResultCache
 
 __author__ = """Dimitris Trypogeorgos"""
 __email__ = 'dtrypogiorgos@gmail.com'
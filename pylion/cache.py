@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+class ResultCache:
+    """Keeps the output files of simulations in a directory so that running
+    the same simulation again restores them instead of running lammps.
+    Entries are found by a key made from everything that decides the
+    result: the lammps input file, which has the seeds of the random
+    numbers in it, the lammps version and the mpi settings.
+
+    With ``prefixes`` it also keeps restart snapshots of simulations that
+    start the same way, so that only the part that differs runs again.
+
+    When the cache grows over ``size`` bytes the entries that were used
+    least recently are removed.
+
+    :param directory: where the output files are kept
+    :param size: largest size of the cache in bytes
+    :param prefixes: reuse snapshots of common prefixes
+    """
+
+    def __init__(self, directory, size=2**30, prefixes=False):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.size = size
+        self.prefixes = prefixes
+
+    @staticmethod
+    def key(script, version, settings=None):
+        """Returns the key of a simulation.
+
+        :param script: contents of the lammps input file
+        :param version: version of lammps
+        :param settings: anything else that changes the result, json
+          serialisable
+        """
+
+        digest = hashlib.sha256()
+        for item in [script, version, json.dumps(settings, sort_keys=True)]:
+            if isinstance(item, str):
+                item = item.encode()
+            # the length keeps the items apart
+            digest.update(f'{len(item)}:'.encode() + item)
+
+        return digest.hexdigest()
+
+    def restore(self, key, filenames):
+        """Copies the files of an entry to the working directory.
+
+        :param key: key of the simulation
+        :param filenames: names of the files to restore
+        :return: True if the entry was found.
+        """
+
+        entry = os.path.join(self.directory, key)
+        if not all(os.path.exists(os.path.join(entry, os.path.basename(name)))
+                   for name in filenames):
+            return False
+
+        for name in filenames:
+            shutil.copyfile(os.path.join(entry, os.path.basename(name)), name)
+
+        # the modification time marks the last use
+        os.utime(entry)
+        return True
+
+    def store(self, key, filenames):
+        """Copies files to a new entry and evicts old entries if the cache
+        is too large.
+
+        :param key: key of the simulation
+        :param filenames: names of the files to keep
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # fill a temporary directory first so a half written entry is
+        # never restored
+        scratch = tempfile.mkdtemp(dir=self.directory, prefix='.')
+        for name in filenames:
+            shutil.copyfile(name,
+                            os.path.join(scratch, os.path.basename(name)))
+
+        entry = os.path.join(self.directory, key)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.rename(scratch, entry)
+
+        self.evict()
+
+    def snapshot(self, key):
+        """Returns the restart file of a prefix or None if it is not in the
+        cache.
+
+        :param key: key of the prefix
+        """
+
+        entry = os.path.join(self.directory, key)
+        restart = os.path.join(entry, 'restart')
+        if not os.path.exists(restart):
+            return None
+
+        os.utime(entry)
+        return restart
+
+    def storesnapshot(self, key, filename):
+        """Keeps the restart file of a prefix.
+
+        :param key: key of the prefix
+        :param filename: name of the restart file
+        """
+
+        scratch = os.path.join(self.directory, 'restart')
+        shutil.copyfile(filename, scratch)
+        self.store(key, [scratch])
+        os.remove(scratch)
+
+    def seen(self, key):
+        """Checks if an earlier simulation had this prefix.
+
+        :param key: key of the prefix
+        """
+
+        return key in self._seen()
+
+    def remember(self, keys):
+        """Notes the prefixes of a simulation so that later ones that share
+        them know to keep a snapshot.
+
+        :param keys: keys of the prefixes
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        seen = sorted(self._seen() | set(keys))
+        with open(os.path.join(self.directory, '.prefixes.json'), 'w') as f:
+            json.dump(seen, f)
+
+    def _seen(self):
+        try:
+            with open(os.path.join(self.directory, '.prefixes.json')) as f:
+                return set(json.load(f))
+        except FileNotFoundError:
+            return set()
+
+    def entries(self):
+        """Returns the keys, sizes and last use of the entries, most
+        recently used first.
+
+        :return: a list of (key, size, time) tuples.
+        """
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(entry, name))
+                       for name in os.listdir(entry))
+            entries.append((key, size, os.path.getmtime(entry)))
+
+        return sorted(entries, key=lambda entry: entry[2], reverse=True)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in
+        its size.
+        """
+
+        total = 0
+        for key, size, _ in self.entries():
+            total += size
+            if total > self.size:
+                shutil.rmtree(os.path.join(self.directory, key))
+
+    def clear(self):
+        """Removes all entries.
+        """
+
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,1197 @@
+import gzip
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import h5py
+import numpy as np
+
+# byte markers of the lammps text dump format
+_TIMESTEP = b'ITEM: TIMESTEP'
+_NUMBER = b'ITEM: NUMBER OF ATOMS'
+_ATOMS = b'ITEM: ATOMS'
+
+# frames are parsed in blocks of roughly this many bytes. Big enough to
+# amortise the per-call overhead of the parser and small enough for the
+# temporary buffers to be negligible next to the output array.
+_BLOCKSIZE = 2**24
+
+# leading bytes of the compressed dumps written by the custom/gz and
+# custom/zstd dump styles
+_MAGIC = {b'\x1f\x8b': 'gzip', b'\x28\xb5\x2f\xfd': 'zstd'}
+
+# dumps larger than this get their frame index cached in a sidecar file.
+# Smaller files are scanned in a few milliseconds anyway.
+_INDEXSIZE = 2**26
+
+
+def _scanframes(buf, start=0, end=None):
+    """Returns the byte offsets of every frame header in ``buf``.
+    """
+
+    end = len(buf) if end is None else end
+
+    offsets = []
+    pos = buf.find(_TIMESTEP, start, end)
+    while pos != -1:
+        offsets.append(pos)
+        pos = buf.find(_TIMESTEP, pos + len(_TIMESTEP), end)
+
+    return np.array(offsets, dtype=np.int64)
+
+
+def _readheader(buf, offset=0):
+    """Reads the number of ions and the column names of the frame that
+    starts at ``offset``.
+    """
+
+    start = buf.find(_NUMBER, offset) + len(_NUMBER) + 1
+    ions = int(buf[start:buf.find(b'\n', start)])
+
+    start = buf.find(_ATOMS, offset) + len(_ATOMS)
+    columns = bytes(buf[start:buf.find(b'\n', start)]).decode().split()
+
+    return ions, columns
+
+
+def _framestep(buf, offset):
+    """Returns the timestep of the frame that starts at ``offset``.
+    """
+
+    start = offset + len(_TIMESTEP) + 1
+    return int(buf[start:buf.find(b'\n', start)])
+
+
+def _frameheader(buf, offset):
+    """Returns the timestep of the frame that starts at ``offset`` and the
+    offset of its first atom line.
+    """
+
+    start = buf.find(b'\n', buf.find(_ATOMS, offset)) + 1
+
+    return _framestep(buf, offset), start
+
+
+def _linespan(buf, start, end, first, last):
+    """Returns the byte range of atom lines ``first`` to ``last`` of the atom
+    block between ``start`` and ``end``.
+    """
+
+    newlines = np.flatnonzero(
+        np.frombuffer(buf[start:end], dtype=np.uint8) == ord('\n'))
+    newlines = np.insert(newlines, 0, -1)
+
+    return start + newlines[first] + 1, start + newlines[last] + 1
+
+
+def _pickids(data, ids):
+    """Picks the ions with the given ``ids`` out of every frame of data. The
+    ids are read from the first column of data.
+    """
+
+    idcol = data[..., 0].astype(np.int64)
+    frames, ions = idcol.shape
+
+    # scatter the row of every ion in a table indexed by id
+    table = np.full((frames, max(idcol.max(), ids.max()) + 1), -1)
+    table[np.arange(frames)[:, None], idcol] = np.arange(ions)
+
+    rows = table[:, ids]
+    if (rows < 0).any():
+        missing = sorted(set(ids[(rows < 0).any(axis=0)].tolist()))
+        raise ValueError(f'Ids {missing} not found in dump.')
+
+    return np.take_along_axis(data, rows[..., None], axis=1)
+
+
+def _sortbyid(data):
+    """Reorders the ions of every frame of data by their id, which is read
+    from the first column of data.
+
+    Lammps does not keep atoms in order between dumps, especially when
+    running on more than one core. Every row is scattered to the position of
+    its id among the sorted ids of the first frame.
+    """
+
+    idcol = data[..., 0].astype(np.int64)
+    frames, ions = idcol.shape
+    if not frames:
+        return data
+
+    ids = np.sort(idcol[0])
+    if ids[0] == 1 and ids[-1] == ions:
+        position = idcol - 1  # the usual case of ids 1 to N
+    else:
+        position = np.searchsorted(ids, idcol).clip(max=ions - 1)
+
+    index = np.arange(frames)[:, None]
+    filled = np.zeros((frames, ions), dtype=bool)
+    filled[index, position] = True
+    if not filled.all() or not np.array_equal(ids[position], idcol):
+        raise ValueError('The ion ids are not the same in every frame.')
+
+    out = np.empty_like(data)
+    out[index, position] = data
+    return out
+
+
+class _Selection:
+    """Columns and ions to read from every frame of a dump.
+
+    Ions are selected either by their position in the frame with ``atoms``
+    or by their ``ids``. If ``sort`` is true the ions of every frame are
+    ordered by id, and positions refer to that order. Otherwise they refer to
+    the order of lines in the dump and only the contiguous span of rows
+    covering ``atoms`` is parsed. Only the selected columns are converted to
+    floats. The id column is kept first if ``keepids`` is true.
+    """
+
+    def __init__(self, header, ions, columns=None, atoms=None, ids=None,
+                 sort=True, keepids=False):
+        if header[0] != 'id':
+            raise TypeError(
+                f"First column should be 'id' not '{header[0]}'.")
+        elif atoms is not None and ids is not None:
+            raise ValueError(
+                'Select ions either by position or by id, not both.')
+
+        columns = header[1:] if columns is None else list(columns)
+        missing = [name for name in columns if name not in header[1:]]
+        if missing:
+            raise ValueError(f'Columns {missing} not found in dump.')
+
+        self.ids = None
+        if ids is not None:
+            self.ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        self.sort = sort and ids is None
+        self.keepids = keepids
+
+        self.usecols = [header.index(name) for name in columns]
+        if self.ids is not None or self.sort or keepids:
+            self.usecols.insert(0, 0)
+
+        self.span = (0, ions)
+        self.rows = None
+        if atoms is not None:
+            rows = np.atleast_1d(np.arange(ions)[atoms])
+            if not len(rows):
+                raise ValueError('No ions selected.')
+
+            # the position of ions is only known after sorting so the whole
+            # frame needs parsing
+            if not self.sort:
+                self.span = (rows.min(), rows.max() + 1)
+                rows -= self.span[0]
+            if not np.array_equal(rows, np.arange(self.span[1]
+                                                  - self.span[0])):
+                self.rows = rows
+
+        if self.rows is not None:
+            selected = len(self.rows)
+        elif self.ids is not None:
+            selected = len(self.ids)
+        else:
+            selected = self.span[1] - self.span[0]
+        self.shape = (selected, len(columns) + keepids)
+
+    def apply(self, data):
+        """Picks the selected ions out of data of shape
+        (frames, span, usecols).
+        """
+
+        if self.ids is not None:
+            data = _pickids(data, self.ids)
+        elif self.sort:
+            data = _sortbyid(data)
+
+        if self.rows is not None:
+            data = data[:, self.rows]
+
+        if self.usecols[:1] == [0] and not self.keepids:
+            return data[..., 1:]
+        return data
+
+
+def _parseframes(buf, bounds, ions, select, ends=None):
+    """Parses the frames delimited by ``bounds`` in one go. If ``ends`` is
+    given the frames are not contiguous and ``bounds`` holds only their
+    start offsets.
+
+    The atom blocks of all frames are stitched together and handed to a
+    single ``np.loadtxt`` call, which only converts the columns in
+    ``select.usecols``. Atom lines outside ``select.span`` are cut out
+    before parsing.
+
+    :return: a tuple of (steps, data) with data.shape=(frames, ions, cols)
+    """
+
+    if ends is None:
+        bounds, ends = bounds[:-1], bounds[1:]
+    frames = len(bounds)
+    first, last = select.span
+
+    steps = np.empty(frames)
+    starts = np.empty(frames, dtype=np.int64)
+    stops = np.array(ends, dtype=np.int64)
+    for i in range(frames):
+        steps[i], starts[i] = _frameheader(buf, bounds[i])
+        if select.span != (0, ions):
+            starts[i], stops[i] = _linespan(buf, starts[i], stops[i], first,
+                                            last)
+
+    # the view has to be released before the buffer is closed so don't keep
+    # any slices of it around
+    with memoryview(buf) as view:
+        text = b''.join(view[start:stop]
+                        for start, stop in zip(starts, stops))
+
+    rows = last - first
+    data = np.loadtxt(io.BytesIO(text), usecols=select.usecols, ndmin=2)
+    if len(data) != frames * rows:
+        raise ValueError(
+            f'Expected {frames * rows} atom lines in {frames} frames but '
+            f'found {len(data)}. Is the number of atoms changing?')
+
+    data = data.reshape(frames, rows, len(select.usecols))
+    return steps, select.apply(data)
+
+
+def _blocks(sizes, size=None):
+    """Splits a sequence of frames with the given sizes in bytes into
+    consecutive groups of roughly ``size`` bytes. Yields index ranges.
+    """
+
+    size = size or _BLOCKSIZE
+    total = np.cumsum(sizes)
+    first = 0
+    while first < len(sizes):
+        last = np.searchsorted(total, total[first] - sizes[first] + size,
+                               'right')
+        last = min(max(last, first + 1), len(sizes))
+        yield first, last
+        first = last
+
+
+def _frameindex(filename, buf):
+    """Returns the offsets and timesteps of every frame in the file.
+
+    The index of large files is cached next to them in ``<filename>.idx``
+    and is rebuilt whenever the size or modification time of the dump
+    changes.
+    """
+
+    stat = os.stat(filename)
+    idxfile = f'{filename}.idx'
+    cache = stat.st_size >= _INDEXSIZE
+
+    if cache:
+        try:
+            with np.load(idxfile) as idx:
+                if (idx['size'] == stat.st_size
+                        and idx['mtime'] == stat.st_mtime_ns):
+                    return idx['offsets'], idx['steps']
+        except (OSError, KeyError, ValueError):
+            pass
+
+    offsets = _scanframes(buf)
+    steps = np.array([_framestep(buf, offset) for offset in offsets],
+                     dtype=np.int64)
+
+    if cache:
+        try:
+            with open(idxfile, 'wb') as f:
+                np.savez(f, offsets=offsets, steps=steps,
+                         size=stat.st_size, mtime=stat.st_mtime_ns)
+        except OSError:
+            pass  # read-only location, scan again next time
+
+    return offsets, steps
+
+
+def _selectframes(steps, frames, steprange=None, stride=1):
+    """Converts a slice of frames or a list of timesteps to an array of
+    frame indices. The frames are further restricted to timesteps in
+    ``steprange=(start, stop)`` and thinned out by ``stride``.
+    """
+
+    if frames is None:
+        select = np.arange(len(steps))
+    elif isinstance(frames, slice):
+        select = np.arange(len(steps))[frames]
+    else:
+        lookup = {step: i for i, step in enumerate(steps.tolist())}
+        try:
+            select = np.array([lookup[step] for step in frames],
+                              dtype=np.int64)
+        except KeyError as e:
+            raise ValueError(f'Timestep {e.args[0]} not found in dump.')
+
+    if steprange is not None:
+        start, stop = steprange
+        if start is not None:
+            select = select[steps[select] >= start]
+        if stop is not None:
+            select = select[steps[select] < stop]
+
+    return select[::stride]
+
+
+def _readworker(filename, name, shape, first, starts, ends, ions, select):
+    """Parses a range of frames into the shared array ``name`` starting at
+    frame ``first``. Runs in a worker process and only returns the steps.
+    """
+
+    steps = np.empty(len(starts))
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        with open(filename, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for i, j in _blocks(ends - starts):
+                steps[i:j], block = _parseframes(buf, starts[i:j], ions,
+                                                 select, ends[i:j])
+                # keep the view short lived so the memory can be closed
+                # even if parsing fails
+                data = np.ndarray(shape, buffer=shm.buf)
+                data[first + i:first + j] = block
+                del data
+    finally:
+        shm.close()
+
+    return steps
+
+
+def _readparallel(filename, starts, ends, ions, select, workers):
+    """Splits the frames into byte ranges of similar size and parses them in
+    a pool of ``workers`` processes. The workers write straight into shared
+    memory so only the steps are sent back.
+    """
+
+    sizes = ends - starts
+    shape = (len(starts),) + select.shape
+
+    # a few tasks per worker to even out the load
+    tasksize = max(int(np.sum(sizes)) // (4 * workers), 1)
+
+    shm = shared_memory.SharedMemory(create=True,
+                                     size=max(int(np.prod(shape)) * 8, 1))
+    try:
+        tasks = [(filename, shm.name, shape, i, starts[i:j], ends[i:j], ions,
+                  select) for i, j in _blocks(sizes, tasksize)]
+        with multiprocessing.Pool(workers) as pool:
+            steps = pool.starmap(_readworker, tasks)
+    except BaseException:
+        shm.close()
+        raise
+    finally:
+        # the name goes but the memory stays until it is closed
+        shm.unlink()
+
+    # return the frames where the workers wrote them instead of copying
+    data = np.ndarray(shape, buffer=shm.buf).view(_SharedArray)
+    data._shm = shm
+
+    return np.concatenate(steps or [np.empty(0)]), data
+
+
+class _SharedArray(np.ndarray):
+    """An array in shared memory that keeps the memory open. It is closed
+    when the array and all its views are gone.
+    """
+
+
+def _readtext(filename, frames, steprange, stride, workers, **selection):
+    """Reads a lammps text dump. See ``readdump``.
+    """
+
+    if not os.path.getsize(filename):
+        return np.empty(0), np.empty((0, 0, 0))
+
+    with open(filename, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        offsets, allsteps = _frameindex(filename, buf)
+        ions, columns = _readheader(buf, offsets[0])
+        select = _Selection(columns, ions, **selection)
+
+        index = _selectframes(allsteps, frames, steprange, stride)
+        starts = offsets[index]
+        ends = np.append(offsets, len(buf))[index + 1]
+
+        if workers > 1:
+            return _readparallel(filename, starts, ends, ions, select,
+                                 workers)
+
+        steps = np.empty(len(index))
+        data = np.empty((len(index),) + select.shape)
+        for first, last in _blocks(ends - starts):
+            steps[first:last], data[first:last] = _parseframes(
+                buf, starts[first:last], ions, select, ends[first:last])
+
+    return steps, data
+
+
+def _binaryheader(f):
+    """Reads the header of the next frame of a lammps binary dump and seeks
+    over its data.
+
+    :return: a tuple of (step, atoms, columns, chunks) where chunks holds the
+      (offset, count) of each block of float64 values of the frame. None at
+      the end of the file or if the last frame is incomplete.
+    """
+
+    raw = f.read(8)
+    if len(raw) < 8:
+        return None
+
+    # newer versions of lammps prefix every frame with a magic string whose
+    # length is written as a negative timestep
+    step, = struct.unpack('=q', raw)
+    revision = 1
+    if step < 0:
+        f.seek(-step, 1)
+        _, revision, step = struct.unpack('=iiq', f.read(16))
+
+    _, triclinic = struct.unpack('=qi', f.read(12))
+    f.seek(6 * 4 + (9 if triclinic else 6) * 8, 1)  # boundary and box
+    size, = struct.unpack('=i', f.read(4))
+
+    columns = None
+    if revision > 1:
+        length, = struct.unpack('=i', f.read(4))
+        f.seek(length, 1)  # unit style
+        if f.read(1) != b'\x00':
+            f.seek(8, 1)  # time
+        length, = struct.unpack('=i', f.read(4))
+        columns = f.read(length).decode().split()
+
+    chunks = []
+    nchunk, = struct.unpack('=i', f.read(4))
+    for _ in range(nchunk):
+        raw = f.read(4)
+        if len(raw) < 4:
+            return None
+        count, = struct.unpack('=i', raw)
+        chunks.append((f.tell(), count))
+        f.seek(8 * count, 1)
+
+    if f.tell() > os.fstat(f.fileno()).st_size:
+        return None
+
+    atoms = sum(count for _, count in chunks) // size
+    return step, atoms, columns or ['id'] + [''] * (size - 1), chunks
+
+
+def _readchunks(f, chunks, out):
+    """Reads the data ``chunks`` of a binary frame straight into ``out``.
+    """
+
+    out = out.reshape(-1)
+    start = 0
+    for offset, count in chunks:
+        f.seek(offset)
+        f.readinto(out[start:start + count])
+        start += count
+
+
+def _readbinary(filename, frames, steprange, stride, **selection):
+    """Reads a lammps binary dump. See ``readdump``.
+    """
+
+    with open(filename, 'rb') as f:
+        headers = list(iter(lambda: _binaryheader(f), None))
+        if not headers:
+            return np.empty(0), np.empty((0, 0, 0))
+
+        _, ions, columns, _ = headers[0]
+        select = _Selection(columns, ions, **selection)
+        first, last = select.span
+
+        steps = np.array([header[0] for header in headers], dtype=np.float64)
+        index = _selectframes(steps, frames, steprange, stride)
+
+        # frames are read whole and the selection is copied out of them
+        frame = np.empty((1, ions, len(columns)))
+        data = np.empty((len(index),) + select.shape)
+        for out, i in zip(data, index):
+            _readchunks(f, headers[i][3], frame)
+            out[...] = select.apply(frame[:, first:last, select.usecols])[0]
+
+    return steps[index], data
+
+
+def _iterbinary(f, **selection):
+    """Yields (steps, data) for every frame of a lammps binary dump.
+    """
+
+    select = None
+    for step, ions, columns, chunks in iter(lambda: _binaryheader(f), None):
+        if select is None:
+            select = _Selection(columns, ions, **selection)
+            first, last = select.span
+
+        frame = np.empty((1, ions, len(columns)))
+        position = f.tell()
+        _readchunks(f, chunks, frame)
+        f.seek(position)
+
+        data = select.apply(frame[:, first:last, select.usecols])
+        yield np.array([step], dtype=np.float64), data
+
+
+def _readtrajectory(filename, frames=None, steprange=None, stride=1,
+                    columns=None, atoms=None, ids=None):
+    """Memory maps a trajectory written by ``convertdump``. See ``readdump``.
+    Slicing keeps the data memory mapped, other selections return copies.
+    """
+
+    with h5py.File(filename, 'r') as f:
+        steps = f['steps'][()]
+        names = json.loads(f.attrs['columns'])
+        dset = f['data']
+        offset = dset.id.get_offset()
+        shape, dtype = dset.shape, dset.dtype
+
+    if offset is None:
+        raise TypeError(f"'{filename}' is not a trajectory file.")
+    elif ids is not None:
+        raise ValueError('Trajectory files do not keep the ion ids. '
+                         'Select ions by position instead.')
+
+    data = np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                     shape=shape)
+
+    if isinstance(frames, slice) and steprange is None:
+        steps, data = steps[frames][::stride], data[frames][::stride]
+    elif frames is not None or steprange is not None or stride != 1:
+        index = _selectframes(steps, frames, steprange, stride)
+        steps, data = steps[index], data[index]
+
+    if atoms is not None:
+        data = data[:, atoms]
+    if columns is not None:
+        missing = [name for name in columns if name not in names]
+        if missing:
+            raise ValueError(f'Columns {missing} not found in dump.')
+        data = data[..., [names.index(name) for name in columns]]
+
+    return steps, data
+
+
+def _dumpformat(filename):
+    """Tells apart text dumps, compressed text dumps, lammps binary dumps
+    and trajectory files.
+    """
+
+    if h5py.is_hdf5(filename):
+        return 'trajectory'
+    elif str(filename).endswith('.bin'):
+        return 'binary'
+
+    with open(filename, 'rb') as f:
+        head = f.read(4)
+    for magic, fmt in _MAGIC.items():
+        if head.startswith(magic):
+            return fmt
+    return 'text'
+
+
+def _opendump(filename, fmt):
+    """Opens a dump for reading in binary mode and decompresses it on the
+    fly if needed.
+    """
+
+    if fmt == 'gzip':
+        return gzip.open(filename, 'rb')
+    elif fmt == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "Reading zstd compressed dumps requires the 'zstandard' "
+                'package. Install it with `pip install zstandard`.')
+
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(filename, 'rb'), read_across_frames=True, closefd=True)
+
+    return open(filename, 'rb')
+
+
+def _readcompressed(filename, fmt, frames, steprange, stride, **selection):
+    """Reads a compressed text dump. See ``readdump``.
+
+    The stream is decoded twice. The first pass only notes the timesteps so
+    the output can be allocated for the selected frames, and the second
+    parses the selected frames of each block straight into it.
+    """
+
+    steps, select = [], None
+    with _opendump(filename, fmt) as f:
+        for buf, bounds in _streamframes(f):
+            if select is None:
+                ions, columns = _readheader(buf, bounds[0])
+                select = _Selection(columns, ions, **selection)
+            steps.extend(_framestep(buf, offset) for offset in bounds[:-1])
+    if select is None:
+        return np.empty(0), np.empty((0, 0, 0))
+
+    steps = np.array(steps, dtype=float)
+    index = _selectframes(steps, frames, steprange, stride)
+    data = np.empty((len(index),) + select.shape)
+
+    # the output slots of the frames in order of the stream
+    slots = np.argsort(index, kind='stable')
+    first = 0
+    with _opendump(filename, fmt) as f:
+        for buf, bounds in _streamframes(f):
+            count = len(bounds) - 1
+            lo, hi = np.searchsorted(index[slots], [first, first + count])
+            if hi > lo:
+                block = index[slots[lo:hi]] - first
+                _, data[slots[lo:hi]] = _parseframes(
+                    buf, bounds[block], ions, select, bounds[block + 1])
+            first += count
+
+    return steps[index], data
+
+
+def readdump(filename, frames=None, workers=1, columns=None, ions=None,
+             ids=None, step_stride=1, steps=None, sort=True,
+             return_ids=False):
+    """Reads data from the given dump file. The dump should be a file
+    with atom quantities in the order `id vargout`, e.g. `id vx vy vz`.
+
+    The file is memory mapped and scanned once for frame headers to find the
+    number of frames and ions. Blocks of frames are then converted in bulk
+    and written straight into a preallocated array, so the memory overhead
+    does not grow with the size of the file. Expect a throughput of about
+    100 MB/s per core.
+
+    Use ``frames`` to read only part of the dump. Frames are located through
+    an index of byte offsets so unselected frames are never parsed, e.g.
+    ``readdump(filename, frames=slice(-1, None))`` loads only the last one.
+
+    Large dumps can be parsed by more than one process with ``workers``.
+    The frames are split in byte ranges of similar size and the results are
+    gathered through shared memory. Remember to guard the calling script with
+    ``if __name__ == '__main__':`` on platforms that spawn new processes.
+
+    Binary dumps written by lammps (files ending in ``.bin``) are read
+    directly, and trajectory files written by ``convertdump`` are memory
+    mapped so data is returned as a ``np.memmap`` that only loads the pages
+    you touch. Dumps compressed with gzip or zstd are decompressed on the fly
+    in large blocks. Only the selected frames are parsed and kept in memory,
+    but the whole stream is decoded, twice, and multiple workers do not
+    speed it up.
+
+    Most analyses only need part of a dump so the selection is pushed down
+    to the parser. Unselected frames are skipped using the frame index,
+    unselected columns are never converted to floats and only the lines
+    spanning the selected ions are parsed. For example, the z coordinate of
+    the first ten ions over the last 20 frames is
+
+    >>> readdump('positions.txt', frames=slice(-20, None), columns=['z'],
+    ...          ions=slice(10))
+
+    Lammps does not keep the ions of a dump in the same order, especially
+    when running on many cores. Every frame is reordered by ion id so an ion
+    keeps its index throughout the dump without having to
+    ``dump_modify sort id``, which serialises output in lammps. Use
+    ``sort=False`` to keep the order of the file, e.g. if it is already
+    sorted, which is a bit faster and lets ``ions`` skip unselected lines.
+
+    :param filename: name of input file
+    :param frames: a slice of frames or a list of timesteps to read.
+      Defaults to all frames.
+    :param workers: number of processes used to parse the file.
+    :param columns: names of the columns to read, e.g. ['z'].
+      Defaults to all columns except for 'id'.
+    :param ions: a slice or a list of ion positions in the frame
+    :param ids: a list of ion ids to read, in that order
+    :param step_stride: read every ``step_stride`` frame
+    :param steps: a tuple of (start, stop) timesteps to read
+    :param sort: order the ions of every frame by id
+    :param return_ids: also return the ids of the ions
+    :return: a tuple of (steps, data) or (steps, data, ids).
+      The shape of data is (steps, ions, (x, y, z)). The shape of ids is
+      (ions,) if the ions are sorted or selected by id and (steps, ions)
+      otherwise.
+    """
+
+    fmt = _dumpformat(filename)
+    if fmt == 'trajectory':
+        if return_ids:
+            raise ValueError('Trajectory files do not keep the ion ids.')
+        # trajectories are sorted when they are converted
+        return _readtrajectory(filename, frames, steps, step_stride,
+                               columns=columns, atoms=ions, ids=ids)
+
+    selection = {'columns': columns, 'atoms': ions, 'ids': ids,
+                 'sort': sort, 'keepids': return_ids}
+    if fmt == 'binary':
+        timesteps, data = _readbinary(filename, frames, steps, step_stride,
+                                      **selection)
+    elif fmt in _MAGIC.values():
+        timesteps, data = _readcompressed(filename, fmt, frames, steps,
+                                          step_stride, **selection)
+    else:
+        timesteps, data = _readtext(filename, frames, steps, step_stride,
+                                    workers, **selection)
+
+    if not return_ids:
+        return timesteps, data
+
+    atomids = data[..., 0].astype(np.int64)
+    if sort or ids is not None:
+        atomids = atomids[0] if len(atomids) else atomids.reshape(-1)
+    return timesteps, data[..., 1:], atomids
+
+
+def _streamframes(f, size=None):
+    """Reads the binary stream ``f`` in blocks and yields (buf, bounds) for
+    every group of complete frames found, with bounds holding the offsets of
+    the frames and the end of the last one.
+    Only a single incomplete frame is carried over between reads.
+    """
+
+    size = size or _BLOCKSIZE
+
+    buf = b''
+    while True:
+        new = f.read(size)
+        buf += new
+        offsets = _scanframes(buf)
+
+        # a frame is complete only once the next one starts or at eof
+        bounds = offsets if new else np.append(offsets, len(buf))
+        if len(bounds) > 1:
+            yield buf, bounds
+            buf = buf[bounds[-1]:]
+
+        if not new:
+            return
+
+
+def _iterstream(f, size=None, **selection):
+    """Reads the binary stream ``f`` in blocks and yields (steps, data) for
+    every group of complete frames found.
+    """
+
+    ions = None
+    for buf, bounds in _streamframes(f, size):
+        if ions is None:
+            ions, columns = _readheader(buf, bounds[0])
+            select = _Selection(columns, ions, **selection)
+
+        yield _parseframes(buf, bounds, ions, select)
+
+
+def _rechunk(blocks, chunk):
+    """Regroups (steps, data) blocks of any length into blocks of exactly
+    ``chunk`` frames. Only the last one can be shorter.
+    """
+
+    steps, data, count = [], [], 0
+    for s, d in blocks:
+        while len(s):
+            take = min(chunk - count, len(s))
+            steps.append(s[:take])
+            data.append(d[:take])
+            s, d = s[take:], d[take:]
+            count += take
+
+            if count == chunk:
+                yield np.concatenate(steps), np.concatenate(data)
+                steps, data, count = [], [], 0
+
+    if count:
+        yield np.concatenate(steps), np.concatenate(data)
+
+
+def iterdump(filename, chunk=1000):
+    """Iterates over the given dump file ``chunk`` frames at a time.
+    Unlike ``readdump`` the whole file is never loaded so memory use stays
+    bounded no matter how large the dump is. Use it for running reductions
+    or windowed analysis of long simulations.
+
+    Example:
+
+    >>> peak = 0
+    >>> for steps, data in iterdump('positions.txt', chunk=100):
+    ...     peak = max(peak, np.abs(data).max())
+
+    The ions of every frame are ordered by id, as in ``readdump``.
+
+    :param filename: name of input file
+    :param chunk: number of frames in each block. The last block may be
+      shorter.
+    :return: a generator of (steps, data) tuples. The shape of data is
+      (chunk, ions, (x, y, z)).
+    """
+
+    fmt = _dumpformat(filename)
+    if fmt == 'trajectory':
+        steps, data = _readtrajectory(filename)
+        for i in range(0, len(steps), chunk):
+            yield steps[i:i + chunk], data[i:i + chunk]
+        return
+
+    with _opendump(filename, fmt) as f:
+        frames = _iterbinary(f) if fmt == 'binary' else _iterstream(f)
+        yield from _rechunk(frames, chunk)
+
+
+def _dumpshape(filename):
+    """Returns the number of frames, ions and the column names of a dump
+    without parsing its data.
+    """
+
+    fmt = _dumpformat(filename)
+    with _opendump(filename, fmt) as f:
+        if fmt == 'binary':
+            index = list(iter(lambda: _binaryheader(f), None))
+            _, ions, columns, _ = index[0]
+            return len(index), ions, columns
+        elif fmt in _MAGIC.values():
+            # count frame headers without parsing, keeping enough bytes
+            # between reads to catch headers split across them
+            block = f.read(_BLOCKSIZE)
+            ions, columns = _readheader(block, block.find(_TIMESTEP))
+            frames, tail = 0, b''
+            while block:
+                block = tail + block
+                frames += block.count(_TIMESTEP)
+                tail = block[1 - len(_TIMESTEP):]
+                block = f.read(_BLOCKSIZE)
+            return frames, ions, columns
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            offsets, _ = _frameindex(filename, buf)
+            return (len(offsets),) + _readheader(buf, offsets[0])
+
+
+def _truncatedump(filename, step):
+    """Removes the frames of a text dump from ``step`` onwards, so that a
+    resumed simulation can append to it.
+    """
+
+    if not os.path.exists(filename) or not os.path.getsize(filename):
+        return
+    elif _dumpformat(filename) != 'text':
+        raise ValueError(f"Only text dumps can be resumed, not '{filename}'.")
+
+    with open(filename, 'r+b') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            end = len(buf)
+            for offset in _scanframes(buf):
+                if _framestep(buf, offset) >= step:
+                    end = int(offset)
+                    break
+        f.truncate(end)
+
+
+def convertdump(filename, output=None, chunk=1000):
+    """Converts a text or binary lammps dump to a trajectory file that
+    ``readdump`` memory maps instead of parsing. The trajectory is an h5
+    file holding the ``steps`` and a contiguous float64 ``data`` array
+    of shape (steps, ions, (x, y, z)) with the ions ordered by id. The
+    column names are stored in the ``columns`` attribute.
+
+    The dump is converted ``chunk`` frames at a time, so it does not need
+    to fit in memory.
+
+    :param filename: name of the dump file
+    :param output: name of the trajectory file. Defaults to the dump name
+      with an ``.h5`` extension.
+    :param chunk: number of frames converted at a time
+    :return: name of the trajectory file
+    """
+
+    if output is None:
+        output = os.path.splitext(filename)[0] + '.h5'
+
+    frames, ions, columns = _dumpshape(filename)
+
+    with h5py.File(output, 'w') as f:
+        f.attrs['columns'] = json.dumps(columns[1:])
+        steps = f.create_dataset('steps', (frames,), dtype=np.float64)
+        # no chunking or compression so the data can be memory mapped
+        data = f.create_dataset('data', (frames, ions, len(columns) - 1),
+                                dtype=np.float64)
+
+        first = 0
+        for s, d in iterdump(filename, chunk):
+            steps[first:first + len(s)] = s
+            data[first:first + len(s)] = d
+            first += len(s)
+
+    return output
+
+
+def _frameend(buf, offset, ions):
+    """Returns the offset just after the last atom line of the frame that
+    starts at ``offset`` or None if lammps has not finished writing it.
+    """
+
+    start = buf.find(_ATOMS, offset)
+    if start == -1 or buf.find(b'\n', start) == -1:
+        return None
+
+    start = buf.find(b'\n', start) + 1
+    newlines = np.flatnonzero(
+        np.frombuffer(buf[start:], dtype=np.uint8) == ord('\n'))
+    if len(newlines) < ions:
+        return None
+
+    return start + newlines[ions - 1] + 1
+
+
+class DumpTail:
+    """Follows a text dump while lammps is still writing it, e.g. to
+    monitor a long simulation or stop it early.
+
+    Every ``poll`` parses only the frames completed since the previous one
+    and remembers where it stopped. Used as a context manager, it polls in a
+    background thread every ``interval`` seconds and hands every new block
+    of frames to ``callback(steps, data)``. Following stops when the
+    callback returns True.
+
+    Example:
+
+    >>> def monitor(steps, data):
+    ...     print(steps[-1], np.abs(data).max())
+    >>> with DumpTail('positions.txt', monitor, interval=10):
+    ...     s.execute()
+
+    :param filename: name of the dump file
+    :param callback: called with (steps, data) of new frames
+    :param interval: seconds between polls in the background thread
+    :param selection: ``columns``, ``ions``, ``ids`` or ``sort`` as in
+      ``readdump``
+    """
+
+    def __init__(self, filename, callback=None, interval=1, **selection):
+        self.filename = filename
+        self.callback = callback
+        self.interval = interval
+        self.position = 0
+
+        if 'ions' in selection:
+            selection['atoms'] = selection.pop('ions')
+        self._selection = selection
+        self._select = None
+        self._ions = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        """Parses the frames completed since the last poll.
+
+        :return: a tuple of (steps, data) with no frames if there was
+          nothing new.
+        """
+
+        try:
+            with open(self.filename, 'rb') as f:
+                # start over if the file was replaced by a new simulation
+                if os.fstat(f.fileno()).st_size < self.position:
+                    self.position = 0
+                f.seek(self.position)
+                buf = f.read()
+        except FileNotFoundError:
+            buf = b''  # lammps has not opened it yet
+
+        offsets = _scanframes(buf)
+        if len(offsets) and self._select is None:
+            atoms = buf.find(_ATOMS, offsets[0])
+            if atoms == -1 or buf.find(b'\n', atoms) == -1:
+                return self._empty()
+            self._ions, columns = _readheader(buf, offsets[0])
+            self._select = _Selection(columns, self._ions, **self._selection)
+
+        # all frames but the last are complete and that only if it has all
+        # its atom lines
+        bounds = list(offsets)
+        if len(offsets):
+            end = _frameend(buf, offsets[-1], self._ions)
+            if end is not None:
+                bounds.append(end)
+        if len(bounds) < 2:
+            return self._empty()
+
+        steps, data = _parseframes(buf, np.array(bounds), self._ions,
+                                   self._select)
+        self.position += bounds[-1]
+        return steps, data
+
+    def _empty(self):
+        shape = self._select.shape if self._select else (0, 0)
+        return np.empty(0), np.empty((0,) + shape)
+
+    def _dispatch(self):
+        steps, data = self.poll()
+        if len(steps) and self.callback is not None:
+            return self.callback(steps, data)
+
+    def follow(self):
+        """Polls every ``interval`` seconds and calls the callback with new
+        frames until ``stop`` is called or the callback returns True.
+        """
+
+        while not self._stopped.wait(self.interval):
+            if self._dispatch():
+                self._stopped.set()
+
+    def start(self):
+        """Starts following the dump in a background thread.
+        """
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.follow, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread and hands over any remaining frames.
+        """
+
+        stopped = self._stopped.is_set()
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if not stopped:
+            self._dispatch()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class DumpStream:
+    """Receives the frames of a dump through a named pipe instead of a file,
+    so nothing is written to disk. Pass it to ``dump(..., stream=...)`` and
+    the simulation creates the pipe, points the lammps dump at it and parses
+    frames in a background thread while it executes.
+
+    New blocks of frames are handed to ``callback(steps, data)`` and the
+    last ``capacity`` frames are kept in a ring buffer that is available
+    through ``frames``. Lammps waits for the callback, so keep it short.
+    Named pipes are only available on posix systems.
+
+    Example:
+
+    >>> stream = DumpStream(capacity=100)
+    >>> s.append(dump('positions', ['x', 'y', 'z'], stream=stream))
+    >>> s.execute()
+    >>> steps, data = stream.frames()
+
+    :param capacity: number of frames kept in memory
+    :param callback: called with (steps, data) of every block of new frames
+    :param selection: ``columns``, ``ions``, ``ids`` or ``sort`` as in
+      ``readdump``
+    """
+
+    def __init__(self, capacity=1000, callback=None, **selection):
+        self.capacity = capacity
+        self.callback = callback
+        self.filename = None
+
+        if 'ions' in selection:
+            selection['atoms'] = selection.pop('ions')
+        self._selection = selection
+        self._steps = None
+        self._data = None
+        self._count = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._error = None
+
+    def open(self, filename):
+        """Creates the named pipe and starts reading from it.
+        """
+
+        if not hasattr(os, 'mkfifo'):
+            raise OSError('Streaming dumps needs named pipes, which are not '
+                          'available on this platform.')
+
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.mkfifo(filename)
+
+        self.filename = filename
+        self._count = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        # unbuffered so every read returns whatever lammps has written
+        with open(self.filename, 'rb', buffering=0) as f:
+            try:
+                for steps, data in _iterstream(f, **self._selection):
+                    self._store(steps, data)
+                    if self.callback is not None:
+                        self.callback(steps, data)
+            except Exception as e:
+                self._error = e
+                # keep draining the pipe so lammps does not block
+                while f.read(_BLOCKSIZE):
+                    pass
+
+    def _store(self, steps, data):
+        if not self.capacity:
+            return
+
+        with self._lock:
+            if self._data is None:
+                self._steps = np.empty(self.capacity)
+                self._data = np.empty((self.capacity,) + data.shape[1:])
+
+            # only the last frames of a large block fit in the buffer
+            steps, data = steps[-self.capacity:], data[-self.capacity:]
+            index = (self._count + np.arange(len(steps))) % self.capacity
+            self._steps[index] = steps
+            self._data[index] = data
+            self._count += len(steps)
+
+    def close(self):
+        """Waits for lammps to close the pipe, removes it and raises any
+        error that happened while parsing.
+        """
+
+        if self._thread is None:
+            return
+
+        # if lammps never opened the pipe the reader is still blocked in
+        # open(). Opening the other end releases it once it gets there.
+        while self._thread.is_alive():
+            try:
+                os.close(os.open(self.filename, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            self._thread.join(0.01)
+        self._thread = None
+        os.remove(self.filename)
+
+        if self._error is not None:
+            raise self._error
+
+    def frames(self):
+        """Returns the frames in the ring buffer, oldest first.
+
+        :return: a tuple of (steps, data).
+        """
+
+        with self._lock:
+            if self._data is None:
+                return np.empty(0), np.empty((0, 0, 0))
+
+            count = min(self._count, self.capacity)
+            index = (self._count - count + np.arange(count)) % self.capacity
+            return self._steps[index], self._data[index]
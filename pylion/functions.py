@@ -1,4 +1,7 @@
 from .lammps import lammps
+from .dumps import readdump, iterdump, convertdump, DumpTail, DumpStream
+from .utils import _CellGrid
+from .pylion import SimulationError
 import numpy as np
 
 
@@ -21,7 +24,7 @@ def efield(uid, ex, ey, ez):
 
 
 @lammps.ions
-def placeions(ions, positions):
+def placeions(ions, positions, velocities=None):
     """Places the given ions at the (x, y, z) coordinates specified.
 
     Example:
@@ -31,37 +34,96 @@ def placeions(ions, positions):
     >>> placeions(ions, positions)
 
     :param ions: dict with keys 'charge', 'mass'
-    :param positions: list of (x, y , z) coodrinates of each ion
+    :param positions: (N, 3) array or list of (x, y , z) coodrinates of
+      each ion
+    :param velocities: (N, 3) array or list of initial (vx, vy, vz) of each
+      ion, zero if not given
     """
 
-    ions.update({'positions': positions})
+    ions.update({'positions': positions, 'velocities': velocities})
 
     return ions
 
 
 @lammps.ions
-def createioncloud(ions, radius, number):
+def createioncloud(ions, radius, number, shape='sphere', separation=None,
+                   seed=None):
     """Creates a cloud of ions that can be added to the trap.
     LAMMPS does have a function that can create ions in a cloud-like
     configuration, but it requires a lattice to be declared, and is
     prone to overlapping ions. As a result, we instead calculate individual
     positions and palce them by hand.
 
+    The ions are uniformly distributed in a ``'sphere'`` of the given radius
+    or an ``'ellipsoid'`` with the given semi-axes, or normally distributed
+    with ``'gaussian'`` and radius as the standard deviation along each axis.
+    The same seed always gives the same cloud. Without a seed the cloud is
+    different every time. It does not follow the legacy ``np.random.seed``
+    any more, so scripts that relied on it must pass ``seed`` instead.
+
+    Example:
+
+    >>> createioncloud(ions, [1e-4, 1e-4, 1e-3], 1000, shape='ellipsoid',
+    ...                separation=1e-6, seed=42)
+
     :param ions: dict with keys 'charge', 'mass'
-    :param radius: radius of cloud
+    :param radius: radius of cloud, or (x, y, z) radii
     :param number: number of atoms
+    :param shape: 'sphere', 'ellipsoid' or 'gaussian'
+    :param separation: smallest distance between ions
+    :param seed: seed of the random numbers or a ``np.random.Generator``
     """
 
-    positions = []
-
-    for ind in range(number):
-        d = np.random.random() * radius
-        a = np.pi * np.random.random()
-        b = 2 * np.pi * np.random.random()
-
-        positions.append([d * np.sin(a) * np.cos(b),
-                          d * np.sin(a) * np.sin(b),
-                          d * np.cos(a)])
+    if shape not in ['sphere', 'ellipsoid', 'gaussian']:
+        raise ValueError(f"Unknown shape '{shape}'. "
+                         "Use 'sphere', 'ellipsoid' or 'gaussian'.")
+    if shape == 'sphere' and np.ndim(radius):
+        raise ValueError("Use shape='ellipsoid' for different radii.")
+
+    rng = np.random.default_rng(seed)
+    radius = np.broadcast_to(np.asarray(radius, dtype=float), 3)
+
+    def draw(count):
+        if shape == 'gaussian':
+            return rng.normal(scale=radius, size=(count, 3))
+
+        # uniform directions and a radial density that grows as r^2
+        directions = rng.normal(size=(count, 3))
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        r = rng.random((count, 1)) ** (1 / 3)
+        return directions * r * radius
+
+    positions = draw(number)
+
+    if separation:
+        # ions that come too close to an earlier one are drawn again. The
+        # ions that are kept go into a grid that is sorted once, and only
+        # the ions drawn again are checked against it and each other.
+        grid, kept = None, []
+        for _ in range(100):
+            keep = np.ones(len(positions), dtype=bool)
+            if grid is not None:
+                keep[grid.query(positions)[1]] = False
+            batch = _CellGrid(positions, separation)
+            first, second = batch.pairs()
+            keep[second[keep[first]]] = False
+
+            if grid is None:
+                batch.remove(np.flatnonzero(~keep))
+                grid = batch
+            else:
+                grid.add(positions[keep])
+            kept.append(positions[keep])
+
+            missing = number - len(grid.keys)
+            if not missing:
+                positions = np.concatenate(kept)
+                break
+            positions = draw(missing)
+        else:
+            raise ValueError(
+                f'Could not place {number} ions {separation} apart. '
+                'Use a larger cloud or a smaller separation.')
 
     ions.update({'positions': positions})
 
@@ -146,6 +208,16 @@ def minimise(etol, ftol, maxiter, maxeval, maxdist):
     return {'code': lines}
 
 
+def _speciesuid(ions):
+    # species are numbered when they are appended to a simulation
+    if ions['uid'] is None:
+        raise SimulationError(
+            'The ions have no uid yet. Append them to the simulation before '
+            'the fixes that use them.')
+
+    return ions['uid']
+
+
 @lammps.fix
 def ionneutralheating(uid, ions, rate):
     """Average heating effect due to collision of ions with
@@ -158,7 +230,7 @@ def ionneutralheating(uid, ions, rate):
 
     rate = abs(rate)  # this is heating after all
     au = 1.66e-27
-    iid = ions['uid']
+    iid = _speciesuid(ions)
     mass = ions['mass']
 
     lines = ['\n# Define ion-neutral heating for a species...',
@@ -207,7 +279,7 @@ def lasercool(uid, ions, k):
 
     force = np.linalg.norm(k)
     kx, ky, kz = np.array(k) / force
-    gid = ions["uid"]
+    gid = _speciesuid(ions)
 
     lines = ['\n# Define laser cooling for a particular atom species.',
              f'group {uid} type {gid}',
@@ -375,7 +447,7 @@ def linearpaultrap(uid, trap, ions=None, all=True):
         if all:
             group = 'all'
         else:
-            group = ions['uid']
+            group = _speciesuid(ions)
 
         sho = _pseudotrap(uid, (kr, kr, kz), group)
 
@@ -418,14 +490,43 @@ def squaresum(uid, variables):
 
 
 @lammps.fix
-def dump(uid, filename, variables, steps=10):
+def dump(uid, filename, variables, steps=10, binary=False, compression=None,
+         stream=None):
     """Dumps variables from lammps into files for analysis.
+    Binary dumps are much faster to write and read back but are not human
+    readable. Lammps decides on the format from the file extension so
+    ``.bin`` is appended to the filename if it is missing.
+
+    Text dumps can also be compressed on the fly with ``compression='gz'``
+    or ``'zstd'``, which appends ``.gz`` or ``.zst`` to the filename. This
+    needs lammps to be built with the COMPRESS package, and the zstandard
+    python package to read zstd dumps back.
+
+    With a ``DumpStream`` the dump is written to a named pipe that is parsed
+    while the simulation runs and no file is left behind.
 
     :param filename: name of output file
     :param variables: list of variables to be written
     :param steps: variables are written every steps
+    :param binary: write a binary dump instead of a text one
+    :param compression: None, 'gz', or 'zstd'
+    :param stream: a ``DumpStream`` that receives the frames
     """
 
+    suffixes = {None: '', 'gz': '.gz', 'zstd': '.zst'}
+    if compression not in suffixes:
+        raise ValueError(f"Unknown compression '{compression}'. "
+                         "Use 'gz' or 'zstd'.")
+    elif binary and compression:
+        raise ValueError('Binary dumps cannot be compressed by lammps.')
+    elif stream is not None and (binary or compression):
+        raise ValueError('Only text dumps can be streamed.')
+
+    style = f'custom/{compression}' if compression else 'custom'
+    suffix = '.bin' if binary else suffixes[compression]
+    if not filename.endswith(suffix):
+        filename += suffix
+
     lines = []
 
     try:
@@ -434,9 +535,9 @@ def dump(uid, filename, variables, steps=10):
     except:
         names = ' '.join(variables)
 
-    lines.append(f'dump {uid} all custom {steps:d} {filename} id {names}\n')
+    lines.append(f'dump {uid} all {style} {steps:d} {filename} id {names}\n')
 
-    return {'code': lines}
+    return {'code': lines, 'stream': stream}
 
 
 def trapaqtovoltage(ions, trap, a, q):
@@ -456,33 +557,3 @@ def trapaqtovoltage(ions, trap, a, q):
     oscV = -q * mass * radius**2 * (2*np.pi * freq)**2 / (2*charge)
 
     return oscV, endcapV
-
-
-def readdump(filename):
-    """Reads data from the given dump file. The dump should be a file
-    with atom quantities in the order `id vargout`, e.g. `id vx vy vz`.
-
-    :param filename: name of input file
-    :return: a tuple of (steps, data).
-      The shape of data is (steps, ions, (x, y, z)).
-    """
-
-    steps = []
-    data = []
-    import time
-
-    with open(filename, 'r') as f:
-        for line in f:
-            if line[6:9] == 'TIM':
-                steps.append(next(f))
-            elif line[6:9] == 'NUM':
-                ions = int(next(f))
-            elif line[6:9] == 'ATO':
-                if line[12:14] != 'id':
-                    raise TypeError
-                block = [next(f).split()[1:] for _ in range(ions)]
-                data.append(block)
-
-    steps = np.array(steps, dtype=np.float)
-    data = np.array(data, dtype=np.float)  # shape=(steps, ions, (x,y,z))
-    return steps, data
@@ -1,5 +1,6 @@
 from .utils import validate_id, _unique_id, pretty_repr
 import functools
+import numpy as np
 
 
 @pretty_repr
@@ -38,23 +39,29 @@ class CfgObject:
 
 
 class Ions(CfgObject):
-    # need to handle this in the class namespace
-    # I'm not sure if this is necessary for all versions of lammps
-    # If not I could handle the ions uid just like any other fix
-    _ids = set()
 
     def __call__(self, *args, **kwargs):
         self.odict = super().__call__(*args, **kwargs)
 
         # if function, charge, mass and rigid are the same it's probably the
-        # same ions definition. Don't increment the set count.
+        # same ions definition. The simulation gives them their uid when
+        # they are appended.
         charge, mass = self.odict['charge'], self.odict['mass']
         rigid = self.odict.get('rigid', False)
 
-        uid = _unique_id(self.func, charge, mass, rigid)
-        Ions._ids.add(uid)
-
-        self.odict['uid'] = len(Ions._ids)
+        self.odict['species'] = _unique_id(self.func, charge, mass, rigid)
+        self.odict['uid'] = None
+
+        # positions and velocities are kept in (N, 3) arrays of floats that
+        # are shared, not copied, by the dicts of the simulation
+        positions = np.ascontiguousarray(self.odict['positions'], dtype=float)
+        self.odict['positions'] = positions.reshape(-1, 3)
+        if self.odict.get('velocities') is not None:
+            velocities = np.ascontiguousarray(self.odict['velocities'],
+                                              dtype=float)
+            if velocities.size != positions.size:
+                raise ValueError('There should be a velocity for each ion.')
+            self.odict['velocities'] = velocities.reshape(-1, 3)
 
         return self.odict.copy()
 
@@ -1,13 +1,24 @@
 import h5py
+import hashlib
+import numpy as np
+import os
 import signal
+import asyncio
 import jinja2 as j2
 import json
+import re
+import bisect
 from datetime import datetime
 from collections import defaultdict
+from functools import lru_cache
 import sys
 import time
 
-from .utils import save_atttributes_and_files
+from .utils import (save_atttributes_and_files, _saveattributesandfiles,
+                    _imbalance, _installedpackages, _lammpsversion,
+                    _writedata)
+from .cache import ResultCache
+from .dumps import _truncatedump
 
 if 'win32' in sys.platform:
     import wexpect as pexpect
@@ -22,6 +33,22 @@ class SimulationError(Exception):
     pass
 
 
+# the environment does not cache templates itself so that a template that
+# changes on disk is compiled again
+_environment = j2.Environment(loader=j2.PackageLoader('pylion', 'templates'),
+                              trim_blocks=True, cache_size=0)
+
+
+def _template(name):
+    filename = os.path.join(os.path.dirname(__file__), 'templates', name)
+    return _compiledtemplate(name, os.path.getmtime(filename))
+
+
+@lru_cache(maxsize=16)
+def _compiledtemplate(name, mtime):
+    return _environment.get_template(name)
+
+
 class Attributes(dict):
     """Light dict wrapper to serve as a container of attributes."""
 
@@ -49,6 +76,14 @@ class Simulation(list):
 
         self.attrs = Attributes()
         self.attrs['executable'] = 'lmp'
+        self.attrs['backend'] = 'pexpect'
+        self.attrs['log'] = 'log.lammps'
+        self.attrs['mpi'] = None
+        self.attrs['acceleration'] = None
+        self.attrs['cache'] = None
+        self.attrs['prefix'] = None
+        self.attrs['checkpoint'] = None
+        self.attrs['thermo'] = {'every': 10000, 'variables': []}
         self.attrs['timestep'] = 1e-6
         self.attrs['domain'] = [1e-3, 1e-3, 1e-3]  # length, width, height
         self.attrs['name'] = name
@@ -57,6 +92,17 @@ class Simulation(list):
         self.attrs['template'] = 'simulation.j2'
         self.attrs['version'] = __version__
         self.attrs['rigid'] = {'exists': False}
+        self.attrs['balance'] = {'exists': False, 'threshold': 1.1,
+                                 'every': 1000}
+
+        # species uids are counted per simulation as ions are appended
+        self._species = {}
+
+        # the output of lammps once the simulation has run, if there is any
+        self.thermo = self.timing = self.runstats = self.activefixes = None
+
+        # set while resume is watching for a restart file it cannot read
+        self._restartfailed = None
 
         # # initalise the h5 file
         # with h5py.File(self.attrs['name'] + '.h5', 'w') as f:
@@ -80,6 +126,13 @@ class Simulation(list):
         if not isinstance(this, dict):
             raise SimulationError("Only 'dicts' are allowed in Simulation().")
 
+        # the same ions definition gets the same uid, a new one the next
+        # uid. Keep the uid if it was set by hand.
+        if this.get('type') == 'ions' and this.get('uid') is None:
+            species = this.get('species')
+            this['uid'] = self._species.setdefault(species,
+                                                   len(self._species) + 1)
+
         self._uids.append(this.get('uid'))
 
         # ions will always be included first so to sort you have
@@ -152,6 +205,10 @@ class Simulation(list):
                 " cases, 'lammps' is probably not going to like it.")
 
         # make sure species will behave
+        if any(ions['uid'] is None for ions in odict['species']):
+            raise SimulationError(
+                "Ions without a 'uid' cannot be written. Species get their "
+                "'uid' when they are appended to the simulation.")
         maxuid = max(odict['species'], key=lambda item: item['uid'])['uid']
         if maxuid > len(odict['species']):
             raise SimulationError(
@@ -160,36 +217,412 @@ class Simulation(list):
                 "Calling '@lammps.ions' decorated functions increments the "
                 "'uid' count unless it is for the same ion group.")
 
-        # load jinja2 template
-        env = j2.Environment(loader=j2.PackageLoader('pylion', 'templates'),
-                             trim_blocks=True)
-        template = env.get_template(self.attrs['template'])
-        rendered = template.render({**self.attrs, **odict})
+        # lammps would not place ions outside the box
+        domain = np.asarray(self.attrs['domain'], dtype=float)
+        for ions in odict['species']:
+            positions = np.asarray(ions['positions'], dtype=float)
+            if np.any(np.abs(positions.reshape(-1, 3)) > domain):
+                raise SimulationError(
+                    f"Ions with uid={ions['uid']} are placed outside the "
+                    f"simulation domain={self.attrs['domain']}.")
 
+        # all ions are read from a data file in one go
+        data = {'filename': self.attrs['name'] + '.data'}
+        _writedata(data['filename'], odict['species'], self.attrs['domain'])
+        with open(data['filename'], 'rb') as f:
+            data['sha256'] = hashlib.sha256(f.read()).hexdigest()
+
+        # balance the ions between processors if a plain spatial split
+        # leaves some of them with much more work than the rest
+        procs = (self.attrs['mpi'] or {}).get('np', 1)
+        if procs > 1:
+            positions = np.concatenate([
+                np.asarray(ions['positions'], dtype=float).reshape(-1, 3)
+                for ions in odict['species']])
+            balance = self.attrs['balance']
+            balance['predicted'] = _imbalance(positions, self.attrs['domain'],
+                                              procs)
+            balance['exists'] = balance['predicted'] > balance['threshold']
+
+        # the accelerated styles need the package to be built in lammps
+        acceleration = self.attrs['acceleration']
+        if acceleration:
+            self._checkacceleration(acceleration)
+
+        # load the compiled jinja2 template and write it out as it renders
+        template = _template(self.attrs['template'])
         with open(self.attrs['name'] + '.lammps', 'w') as f:
-            f.write(rendered)
+            template.stream({**self.attrs, **odict, 'data': data}).dump(f)
+        self.attrs['script'] = self.attrs['name'] + '.lammps'
+
+        # keep the items to restart from a prefix of them
+        self._items = odict['simulation']
+        self.attrs['prefix'] = None
 
         # get a few more attrs now that the lammps file is written
         # - simulation time
         self.attrs['time'] = datetime.now().isoformat()
 
         # - names of the output files
+        # streamed dumps go through named pipes and leave no files
         fixes = filter(lambda item: item.get('type') == 'fix',
                        odict['simulation'])
-        self.attrs['output_files'] = [line.split()[5] for fix in fixes
-                                      for line in fix['code']
-                                      if line.startswith('dump')]
+        dumps = [(line.split()[5], fix.get('stream')) for fix in fixes
+                 for line in fix['code'] if line.startswith('dump')]
+        self.attrs['output_files'] = [filename for filename, stream in dumps
+                                      if stream is None]
+        self._streams = {filename: stream for filename, stream in dumps
+                         if stream is not None}
+
+    @property
+    def _header(self):
+        # the script without the code of the items or None if the template
+        # puts something after them
+        with open(self.attrs['name'] + '.lammps') as f:
+            rendered = f.read()
+        body = ''.join(line + '\n' for item in self._items
+                       for line in item['code'])
+
+        return (rendered[:len(rendered) - len(body)]
+                if rendered.endswith(body) else None)
+
+    def _checkacceleration(self, acceleration):
+        names = {'omp': ['OPENMP', 'USER-OMP'], 'opt': ['OPT'],
+                 'intel': ['INTEL', 'USER-INTEL']}
+        package = acceleration.get('package')
+        if package not in names:
+            raise SimulationError(f"Unknown acceleration package '{package}'. "
+                                  "Use 'omp', 'opt' or 'intel'.")
+
+        # the library backend has no executable to ask
+        if self.attrs['backend'] != 'pexpect':
+            return
+
+        executable = self.attrs['executable']
+        try:
+            installed = _installedpackages(executable)
+        except OSError as e:
+            raise SimulationError(
+                f"Could not run '{executable} -h' to check for the "
+                f"'{package}' package.") from e
+
+        if installed.isdisjoint(names[package]):
+            raise SimulationError(
+                f"'{executable}' was not built with the {names[package][0]} "
+                f"package needed for '{package}' acceleration.")
 
     @save_atttributes_and_files
-    def execute(self):
+    def execute(self, callback=None, every=1000, progress=None, quiet=False):
         """Write lammps input file and run the simulation.
+
+        With the default ``'pexpect'`` backend lammps runs as a subprocess.
+        The ``'library'`` backend drives lammps in this process through its
+        python module. Only then ``callback(simulation)`` can be given and
+        it is called every ``every`` steps of each run, where it can look
+        at the ions with ``positions`` and ``velocities``.
+
+        With the ``'pexpect'`` backend the thermo output is collected in
+        ``thermo`` and ``progress(info)`` is called for every thermo line
+        with a dict of the ``step``, ``steps``, ``progress``,
+        ``steps_per_second``, ``ns_per_day`` and ``eta`` in seconds.
+
+        :param callback: called with the simulation during runs
+        :param every: number of steps between callbacks
+        :param progress: called with the progress of the simulation
+        :param quiet: do not print the lammps output
         """
 
         if getattr(self, '_hasexecuted', False):
             raise SimulationError(
                 'Simulation has executed already. Do not run it again.')
 
+        backend = self.attrs['backend']
+        if backend not in ['pexpect', 'library']:
+            raise SimulationError(f"Unknown backend '{backend}'. "
+                                  "Use 'pexpect' or 'library'.")
+        elif callback is not None and backend != 'library':
+            raise SimulationError("Callbacks need the 'library' backend.")
+        elif (progress is not None or quiet) and backend == 'library':
+            raise SimulationError(
+                "Progress and quiet need the 'pexpect' backend. The "
+                "'library' backend leaves the output to lammps.")
+        elif self.attrs['mpi'] and backend == 'library':
+            raise SimulationError(
+                "The 'library' backend cannot launch lammps with mpi. "
+                "Use the 'pexpect' backend.")
+
+        self._writeinputfile()
+
+        # callbacks and streams need lammps to actually run
+        cache = self.attrs['cache']
+        if cache and callback is None and not self._streams:
+            cache = ResultCache(**cache)
+            key = self._cachekey()
+            files = self.attrs['output_files'] + [self.attrs['log']]
+            if cache.restore(key, files):
+                print(f'Restored the output files from {cache.directory}.')
+                self._hasexecuted = True
+                return
+
+            if cache.prefixes:
+                self._writeprefixscript(cache)
+        else:
+            cache = None
+
+        self._ends = []
+        completed = self._run(callback, every, progress, quiet)
+
+        # do not keep the results of simulations that stopped early
+        if cache is not None and completed:
+            cache.store(key, files)
+            if cache.prefixes:
+                self._storeprefix(cache)
+
+        self._hasexecuted = True
+
+    def _run(self, callback=None, every=1000, progress=None, quiet=False):
+        # named pipes must exist before lammps opens them for the dumps
+        streams = []
+        try:
+            for filename, stream in self._streams.items():
+                stream.open(filename)
+                streams.append(stream)
+
+            if self.attrs['backend'] == 'library':
+                return self._executelibrary(callback, every)
+            else:
+                return self._executepexpect(progress, quiet)
+        finally:
+            for stream in streams:
+                stream.close()
+            if self.attrs['checkpoint']:
+                self._prunecheckpoints()
+
+    @save_atttributes_and_files
+    def resume(self, progress=None, quiet=False):
+        """Continues a simulation that stopped before it finished from its
+        latest checkpoint. Build the simulation the same way as the first
+        time and call ``resume`` instead of ``execute``. Text dumps are cut
+        back to the checkpoint and appended to.
+
+        :param progress: called with the progress of the simulation
+        :param quiet: do not print the lammps output
+        """
+
+        if not self.attrs['checkpoint']:
+            raise SimulationError(
+                "Only simulations with attrs['checkpoint'] can be resumed.")
+        elif ((progress is not None or quiet)
+              and self.attrs['backend'] == 'library'):
+            raise SimulationError(
+                "Progress and quiet need the 'pexpect' backend. The "
+                "'library' backend leaves the output to lammps.")
+
         self._writeinputfile()
+        self._prunecheckpoints()
+        checkpoints = self._checkpoints()
+        if not checkpoints or self._header is None:
+            raise SimulationError('There is no checkpoint to resume from.')
+
+        try:
+            with open(self.attrs['name'] + '.checkpoint.json') as f:
+                ends = json.load(f)
+        except FileNotFoundError:
+            ends = []
+
+        # the latest restart file may have been cut short when lammps
+        # stopped, then the one before it is used
+        for step, restart in reversed(checkpoints):
+            self._writeresumescript(step, restart, ends)
+            print(f'Resuming from step {step} of {restart}.')
+            self._restartfailed = False
+            self._run(progress=progress, quiet=quiet)
+            if not self._restartfailed:
+                break
+            print(f'Could not read {restart}.')
+
+        self._hasexecuted = True
+
+    def _writeresumescript(self, step, restart, ends):
+        # the runs and minimisations that had finished by the checkpoint and
+        # whether it was written during the next one
+        done = bisect.bisect_right(ends, step)
+        start = ends[done - 1] if done else 0
+        within = step > start
+        self._ends = ends[:done]
+
+        skip = {'read_data', 'create_atoms', 'velocity', 'displace_atoms',
+                'delete_atoms'}
+        lines = [f"log {self.attrs['log']} append"]
+        count = 0
+        for item in [None] + self._items:
+            code = self._header.splitlines() if item is None else item['code']
+            for line in '\n'.join(code).splitlines():
+                words = line.split() or ['']
+                if count > done:
+                    lines.append(line)
+                elif words[0] in ['run', 'minimize']:
+                    if count == done and words[0] == 'run' and len(words) == 2:
+                        lines.append(f'run {start + int(words[1]):d} upto')
+                    elif count == done:
+                        lines.append(line)
+                    count += 1
+                elif words[0] == 'create_box':
+                    lines.append(f'read_restart {restart}')
+                elif words[0] in skip and (count < done or within):
+                    continue
+                elif words[0] == 'dump':
+                    _truncatedump(words[5], step)
+                    lines.append(line)
+                    lines.append(f'dump_modify {words[1]} append yes')
+                else:
+                    lines.append(line)
+
+        if count <= done:
+            raise SimulationError('The simulation had finished already.')
+
+        script = self.attrs['name'] + '.resume.lammps'
+        with open(script, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.attrs['script'] = script
+        self.attrs['checkpoint']['resumed'] = step
+
+    def _checkpoints(self):
+        # restart files are named after the step they were written at
+        name = re.escape(self.attrs['name'])
+        pattern = re.compile(name + r'\.(\d+)\.restart')
+        checkpoints = []
+        for filename in os.listdir('.'):
+            match = pattern.fullmatch(filename)
+            if match:
+                checkpoints.append((int(match.group(1)), filename))
+
+        return sorted(checkpoints)
+
+    def _recordend(self, step):
+        # the steps at which runs end tell where to resume from
+        if not self.attrs['checkpoint']:
+            return
+
+        self._ends = getattr(self, '_ends', []) + [step]
+        with open(self.attrs['name'] + '.checkpoint.json', 'w') as f:
+            json.dump(self._ends, f)
+        self._prunecheckpoints()
+
+    def _prunecheckpoints(self):
+        # only the two latest restart files are kept since the latest one
+        # may still be written
+        for _, filename in self._checkpoints()[:-2]:
+            os.remove(filename)
+
+    def _cachekey(self, script=None, prefix=False):
+        if self.attrs['backend'] == 'library':
+            import lammps
+            version = str(getattr(lammps, '__version__', 'unknown'))
+        else:
+            version = _lammpsversion(self.attrs['executable'])
+
+        if script is None:
+            with open(self.attrs['name'] + '.lammps') as f:
+                script = f.read()
+
+        # prefixes are snapshots, not results, even for the same script
+        return ResultCache.key(script, version, {
+            'backend': self.attrs['backend'], 'mpi': self.attrs['mpi'],
+            'prefix': prefix})
+
+    def _prefixes(self):
+        # keys of the scripts that end with a run or minimisation, up to the
+        # first dump so that no output is lost by skipping the prefix
+        prefixes = []
+        script = self._header
+        for index, item in enumerate(self._items):
+            commands = [line.split()[0] for code in item['code']
+                        for line in code.splitlines() if line.split()]
+            if 'dump' in commands:
+                break
+
+            script += ''.join(line + '\n' for line in item['code'])
+            if {'run', 'minimize'} & set(commands):
+                prefixes.append((index + 1, self._cachekey(script, True)))
+
+        return prefixes
+
+    def _writeprefixscript(self, cache):
+        """Writes a script that starts from the snapshot of the longest
+        prefix in the cache and snapshots the longest prefix that earlier
+        runs share with this one.
+        """
+
+        if self._header is None:
+            return
+
+        prefixes = self._prefixes()
+        # the header alone is never a prefix so 0 means none
+        read, write = 0, 0
+        for index, key in prefixes:
+            if cache.snapshot(key) is not None:
+                read, readkey = index, key
+        for index, key in prefixes:
+            if index > read and cache.seen(key):
+                write, writekey = index, key
+
+        if not (read or write):
+            self.attrs['prefix'] = {'keys': [key for _, key in prefixes]}
+            return
+
+        # settings are kept but the state comes from the snapshot
+        skip = {'create_box', 'read_data', 'create_atoms', 'run', 'minimize',
+                'velocity', 'displace_atoms', 'delete_atoms'}
+        lines = []
+        # the header is the first piece and items follow
+        for index, item in enumerate([None] + self._items):
+            code = self._header.splitlines() if item is None else item['code']
+            for line in '\n'.join(code).splitlines():
+                words = line.split()
+                if (not read or index > read or not words
+                        or words[0] not in skip):
+                    lines.append(line)
+                elif words[0] == 'create_box':
+                    lines.append(f'read_restart {cache.snapshot(readkey)}')
+
+            if write and index == write:
+                lines.append(f"write_restart {self.attrs['name']}.restart")
+
+        script = self.attrs['name'] + '.prefix.lammps'
+        with open(script, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        self.attrs['script'] = script
+        self.attrs['prefix'] = {'keys': [key for _, key in prefixes],
+                                'read': read,
+                                'write': writekey if write else None}
+        if read:
+            print(f'Starting from the snapshot after {read} items.')
+
+    def _storeprefix(self, cache):
+        prefix = self.attrs['prefix']
+        if prefix is None:
+            return
+
+        if prefix.get('write'):
+            restart = self.attrs['name'] + '.restart'
+            cache.storesnapshot(prefix['write'], restart)
+            os.remove(restart)
+
+        cache.remember(prefix['keys'])
+
+    def _inputfile(self):
+        return self.attrs.get('script') or self.attrs['name'] + '.lammps'
+
+    def _logfile(self):
+        # resumed simulations append to the log from their script
+        if self._inputfile() == self.attrs['name'] + '.resume.lammps':
+            return 'none'
+
+        return self.attrs['log']
+
+    def _executepexpect(self, progress=None, quiet=False):
 
         def signal_handler(sig, frame):
             print('Simulation terminated by the user.')
@@ -198,30 +631,497 @@ class Simulation(list):
 
         signal.signal(signal.SIGINT, signal_handler)
 
-        child = pexpect.spawn(' '.join([self.attrs['executable'], '-in',
-                              self.attrs['name'] + '.lammps']), timeout=None,
+        command = self._command()
+        child = pexpect.spawn(command[0], command[1:], timeout=None,
                               encoding='utf8')
+        self._child = child
 
-        self._process_stdout(child)
+        self._process_stdout(child, progress, quiet)
         child.close()
+        self._child = None
+
+        return child.exitstatus == 0
+
+    async def execute_async(self):
+        """Write lammps input file and start the simulation without blocking
+        the event loop. Many simulations can run concurrently this way.
+
+        Example:
+
+        >>> run = await s.execute_async()
+        >>> async for line in run:
+        ...     print(f'{run.progress:.0%}', line)
+        >>> h5file = await run.wait()
+
+        :return: a ``SimulationRun`` to follow the simulation.
+        """
+
+        if getattr(self, '_hasexecuted', False):
+            raise SimulationError(
+                'Simulation has executed already. Do not run it again.')
+        elif self.attrs['backend'] != 'pexpect':
+            raise SimulationError(
+                "Only the 'pexpect' backend can run asynchronously.")
+
+        self._writeinputfile()
+
+        streams = []
+        try:
+            for filename, stream in self._streams.items():
+                stream.open(filename)
+                streams.append(stream)
+
+            command = self._command()
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT)
+        except BaseException:
+            for stream in streams:
+                stream.close()
+            raise
 
         self._hasexecuted = True
 
-    def _process_stdout(self, child):
-        atoms = 0
+        return SimulationRun(self, process, streams)
+
+    def _command(self):
+        command = [self.attrs['executable'], '-in', self._inputfile(),
+                   '-log', self._logfile()]
+
+        mpi = self.attrs['mpi']
+        if mpi:
+            # '-n' is understood by mpirun, mpiexec and srun alike
+            launcher = [mpi.get('launcher', 'mpirun'), '-n', f"{mpi['np']:d}"]
+            command = launcher + list(mpi.get('args', [])) + command
+
+        return command
+
+    def _executelibrary(self, callback, every):
+        try:
+            from lammps import lammps
+        except ImportError:
+            raise SimulationError(
+                "The 'library' backend needs the lammps python module. "
+                "Build lammps as a shared library and install its python "
+                "package or use the 'pexpect' backend.")
+
+        with open(self._inputfile()) as f:
+            lines = f.read().replace('&\n', ' ').splitlines()
+
+        # lammps prints to stdout and the log by itself
+        lmp = lammps(cmdargs=['-log', self._logfile()])
+        self._lmp = lmp
+        self._terminated = False
+        try:
+            for line in lines:
+                if self._terminated:
+                    print('Simulation terminated early.')
+                    break
+
+                words = line.split()
+                if not words or words[0].startswith('#'):
+                    continue
+
+                if (words[0] == 'run' and len(words) == 2
+                        and words[1].isdigit() and callback):
+                    self._runlibrary(lmp, int(words[1]), callback, every)
+                    self._recordend(lmp.extract_global('ntimestep'))
+                elif words[0] in ['run', 'minimize']:
+                    lmp.command(line)
+                    self._recordend(lmp.extract_global('ntimestep'))
+                elif words[0] == 'read_restart':
+                    try:
+                        lmp.command(line)
+                    except Exception:
+                        # only resume tries another restart file
+                        if self._restartfailed is None:
+                            raise
+                        self._restartfailed = True
+                        return False
+                else:
+                    lmp.command(line)
+        finally:
+            self._lmp = None
+            lmp.close()
+
+        return not self._terminated
+
+    def _runlibrary(self, lmp, steps, callback, every):
+        # split the run in pieces that lammps treats as a single run so
+        # that time-dependent fixes are not affected
+        start = lmp.extract_global('ntimestep')
+        done = 0
+        while done < steps and not self._terminated:
+            chunk = min(every, steps - done)
+            pre = 'yes' if done == 0 else 'no'
+            post = 'yes' if done + chunk == steps else 'no'
+            lmp.command(f'run {chunk} start {start} stop {start + steps} '
+                        f'pre {pre} post {post}')
+            done += chunk
+            callback(self)
+
+    def _extract(self, name):
+        lmp = getattr(self, '_lmp', None)
+        if lmp is None:
+            raise SimulationError(
+                "Ions can only be accessed during a simulation with the "
+                "'library' backend.")
+
+        return lmp.numpy.extract_atom('id'), lmp.numpy.extract_atom(name)
+
+    def positions(self):
+        """Returns the ids and positions of the ions while a simulation
+        runs with the ``'library'`` backend. These are views of the lammps
+        memory in its own order, valid only until lammps continues.
+
+        :return: a tuple of (ids, positions).
+        """
+
+        return self._extract('x')
+
+    def velocities(self):
+        """Returns the ids and velocities of the ions while a simulation
+        runs with the ``'library'`` backend. Like ``positions`` these are
+        views of the lammps memory.
+
+        :return: a tuple of (ids, velocities).
+        """
+
+        return self._extract('v')
+
+    def terminate(self):
+        """Stops a running simulation. Use it from another thread, e.g. a
+        ``DumpTail`` callback, to end a simulation early. The output files
+        are still saved as if the simulation had finished.
+        With the ``'library'`` backend lammps stops at the next command or
+        callback.
+        """
+
+        if getattr(self, '_lmp', None) is not None:
+            self._terminated = True
+            return
+
+        child = getattr(self, '_child', None)
+        if child is not None and child.isalive():
+            print('Simulation terminated early.')
+            child.terminate()
+
+    def _process_stdout(self, child, progress=None, quiet=False):
+        self._startoutput(progress)
         for line in child:
-            line = line.rstrip('\r\n')
-            if line == 'Created 1 atoms':
-                atoms += 1
-                continue
-            elif line == 'Created 0 atoms':
-                raise SimulationError(
-                    'lammps created 0 atoms - perhaps you placed ions '
-                    'with positions outside the simulation domain?')
+            line = self._parseline(line)
+            if line is not None and not quiet:
+                print(line)
+        self._finishoutput()
+
+    def _startoutput(self, progress=None):
+        self._atoms, self._thermo, self._step = 0, False, 0
+        self._thermoblocks = []
+        self._runstats, self._timingnames = [], None
+        self._progress = progress
+
+        # the total is unknown if a run takes its steps from a variable
+        runs = [line.split()[1] for item in self
+                for line in item.get('code', [])
+                if line.startswith('run ') and len(line.split()) > 1]
+        if all(run.isdigit() for run in runs):
+            self._steps = sum(int(run) for run in runs)
+        else:
+            self._steps = 0
+
+    def _finishoutput(self):
+        """Collects the thermo output and the timing breakdowns of the runs
+        in record arrays and works out the average speed of the simulation.
+        """
+
+        self._data = {}
+        self._finishthermo()
+        self._finishtiming()
+
+    def _finishthermo(self):
+        self.thermo = None
+        if not self._thermoblocks:
+            return
+
+        # blocks with other columns come from thermo_style commands of the
+        # user and are left out
+        names = self._thermoblocks[0][0]
+        rows = [row for blocknames, block in self._thermoblocks
+                for row in block if blocknames == names]
+        if not rows:
+            # lammps stopped right after the header
+            return
+        self.thermo = np.rec.fromrecords(rows, names=names)
+        self._data['thermo'] = self.thermo
+
+        if 'cpu' in names:
+            # cpu is the time since the start of each run
+            steps = sum(block[-1][0] - block[0][0]
+                        for blocknames, block in self._thermoblocks
+                        if block and blocknames == names)
+            seconds = sum(block[-1][names.index('cpu')]
+                          for blocknames, block in self._thermoblocks
+                          if block and blocknames == names)
+            if seconds > 0:
+                rate = steps / seconds
+                self.attrs['performance'] = {
+                    'steps_per_second': rate,
+                    'ns_per_day': rate * self.attrs['timestep'] * 86400e9}
+
+    def _finishtiming(self):
+        self.runstats = self.timing = self.activefixes = None
+        if not self._runstats:
+            return
+
+        fields = ['loop', 'procs', 'steps', 'atoms', 'nlocal', 'nghost',
+                  'neighs', 'neighbors', 'builds', 'dangerous']
+        self.runstats = np.rec.fromrecords(
+            [tuple(stats.get(field, np.nan) for field in fields)
+             for stats in self._runstats], names=fields)
+        self._data['runstats'] = self.runstats
+
+        columns = ['min', 'avg', 'max', 'varavg', 'cpu', 'total']
+        rows = [(run, section) + tuple(times.get(name, np.nan)
+                                       for name in columns)
+                for run, stats in enumerate(self._runstats)
+                for section, times in stats['sections'].items()]
+        if not rows:
+            return
+        self.timing = np.rec.fromrecords(
+            rows, dtype=[('run', int), ('section', 'S8')]
+            + [(name, float) for name in columns])
+        self._data['timing'] = self.timing
+
+        # lammps times all fixes together in the Modify section, so only
+        # note which fixes were defined in each run
+        rows = [(run, fix, style)
+                for run, active in enumerate(self._activefixes())
+                for fix, style in active.items()]
+        if not rows:
+            return
+        self.activefixes = np.rec.fromrecords(
+            rows, dtype=[('run', int), ('fix', 'S32'), ('style', 'S32')])
+        self._data['activefixes'] = self.activefixes
+
+    def _activefixes(self):
+        # the fixes that are defined during each run or minimisation of
+        # the script that ran, by their ids
+        active, runs = {}, []
+        with open(self._inputfile()) as f:
+            for line in f:
+                words = line.split()
+                if words[:1] == ['fix'] and len(words) > 3:
+                    active[words[1]] = words[3]
+                elif words[:1] == ['unfix'] and len(words) > 1:
+                    active.pop(words[1], None)
+                elif words[:1] in (['run'], ['minimize']):
+                    runs.append(dict(active))
+
+        return runs
+
+    def _parseline(self, line):
+        """Checks a line of lammps output and keeps track of its progress.
+        Returns the line to show or None.
+        """
+
+        line = line.rstrip('\r\n')
+        words = line.split()
+        if line == 'Created 1 atoms':
+            self._atoms += 1
+            return None
+        elif line == 'Created 0 atoms':
+            raise SimulationError(
+                'lammps created 0 atoms - perhaps you placed ions '
+                'with positions outside the simulation domain?')
+        elif line.strip().startswith('initial/final imbalance factor'):
+            factors = [float(f) for f in line.split('=')[1].split()]
+            self.attrs['balance']['imbalance'] = factors
+        elif line.startswith('ERROR') and 'restart' in line.lower():
+            # restart files are only read before the first run
+            if self._restartfailed is False and not self._thermoblocks:
+                self._restartfailed = True
+        elif words[:1] == ['Step']:
+            self._thermo = True
+            self._thermoblocks.append((self._thermonames(words), []))
+        elif line.startswith('Loop time'):
+            self._thermo = False
+            self._recordend(self._step)
+            self._parseloop(words)
+        elif self._thermo and words and words[0].isdigit():
+            step, self._step = self._step, int(words[0])
+            self._parsethermo(words)
+            # a new restart file is written every so many steps
+            every = int((self.attrs['checkpoint'] or {}).get('every', 0))
+            if every and step // every < self._step // every:
+                self._prunecheckpoints()
+        elif self._runstats and not self._thermo:
+            self._parsestats(line, words)
+
+        if self._atoms:
+            atoms, self._atoms = self._atoms, 0
+            return f'Created {atoms} atoms.'
+
+        return line
+
+    def _parseloop(self, words):
+        # Loop time of 0.1 on 1 procs for 1000 steps with 2 atoms
+        stats = {'sections': {}}
+        for name, index in [('loop', 3), ('procs', 5), ('steps', 8),
+                            ('atoms', 11)]:
+            try:
+                stats[name] = float(words[index])
+            except (IndexError, ValueError):
+                pass
+        self._runstats.append(stats)
+        self._timingnames = None
+
+    def _parsestats(self, line, words):
+        stats = self._runstats[-1]
+        if '|' in line:
+            cells = [cell.strip() for cell in line.split('|')]
+            if cells[0] == 'Section':
+                # e.g. min time, %varavg, %CPU
+                self._timingnames = [cell.strip('%').split(' ')[0].lower()
+                                     for cell in cells[1:]]
+            elif self._timingnames and cells[0]:
+                times = {}
+                for name, cell in zip(self._timingnames, cells[1:]):
+                    try:
+                        times[name] = float(cell)
+                    except ValueError:
+                        pass
+                stats['sections'][cells[0]] = times
+            return
+
+        names = {'Nlocal:': 'nlocal', 'Nghost:': 'nghost', 'Neighs:': 'neighs',
+                 'Total # of neighbors': 'neighbors',
+                 'Neighbor list builds': 'builds',
+                 'Dangerous builds': 'dangerous'}
+        for prefix, name in names.items():
+            if line.startswith(prefix):
+                # the average over the processes comes first
+                value = (words[1] if prefix.endswith(':')
+                         else line.split('=')[-1].strip())
+                try:
+                    stats[name] = float(value)
+                except ValueError:
+                    pass
+
+    def _thermonames(self, header):
+        # lammps prints its own names for the columns, e.g. PotEng for pe.
+        # Use the ones of the simulation if the header is for them.
+        names = ['step', 'cpu'] + self.attrs['thermo']['variables']
+        if len(header) != len(names):
+            names = [name.lower() for name in header]
+
+        return names
+
+    def _parsethermo(self, words):
+        names, block = self._thermoblocks[-1]
+        try:
+            row = tuple(float(word) for word in words)
+        except ValueError:
+            return
+        if len(row) != len(names):
+            return
+        block.append(row)
+
+        if self._progress is None:
+            return
+
+        steps = self._steps
+        info = {'step': self._step, 'steps': steps,
+                'progress': min(self._step / steps, 1) if steps else 0.0,
+                'steps_per_second': None, 'ns_per_day': None, 'eta': None}
+
+        # the speed since the last thermo output
+        if 'cpu' in names and len(block) > 1:
+            cpu = names.index('cpu')
+            seconds = block[-1][cpu] - block[-2][cpu]
+            if seconds > 0:
+                rate = (block[-1][0] - block[-2][0]) / seconds
+                info['steps_per_second'] = rate
+                info['ns_per_day'] = rate * self.attrs['timestep'] * 86400e9
+                if steps:
+                    info['eta'] = max(steps - self._step, 0) / rate
+
+        self._progress(info)
+
+
+class SimulationRun:
+    """Follows a simulation started with ``Simulation.execute_async``.
+    Iterate over it asynchronously to get the lines of lammps output as
+    they come, and wait for it to save the results in the h5 file.
+
+    :param simulation: the simulation that is running
+    :param process: the lammps process
+    :param streams: ``DumpStream`` objects reading from the simulation
+    """
+
+    def __init__(self, simulation, process, streams=()):
+        self.simulation = simulation
+        self.process = process
+        self._streams = list(streams)
+
+        simulation._startoutput()
+        simulation._ends = []
+        self.steps = simulation._steps
+
+        self._lines = self._readlines()
+        self._h5file = None
+
+    @property
+    def step(self):
+        """The last step lammps reported."""
+        return self.simulation._step
+
+    @property
+    def progress(self):
+        """Fraction of the steps done so far."""
+        return min(self.step / self.steps, 1) if self.steps else 0.0
+
+    def __aiter__(self):
+        return self._lines
+
+    async def _readlines(self):
+        async for line in self.process.stdout:
+            line = self.simulation._parseline(line.decode(errors='replace'))
+            if line is not None:
+                yield line
+
+    def cancel(self):
+        """Stops lammps. The output files are still saved by ``wait``.
+        """
+
+        if self.process.returncode is None:
+            self.process.terminate()
+
+    async def wait(self):
+        """Waits for lammps to finish and saves the simulation.
+
+        :return: the name of the h5 file.
+        """
+
+        if self._h5file is not None:
+            return self._h5file
+
+        try:
+            # the output has to be read for lammps not to block
+            async for line in self:
+                pass
+            await self.process.wait()
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+        finally:
+            loop = asyncio.get_running_loop()
+            for stream in self._streams:
+                await loop.run_in_executor(None, stream.close)
 
-            if atoms:
-                print(f'Created {atoms} atoms.')
-                atoms = False
-                continue
+        self.simulation._finishoutput()
+        attrs = self.simulation.attrs
+        _saveattributesandfiles(attrs, depth=None,
+                                data=self.simulation._data)
+        self._h5file = attrs['name'] + '.h5'
 
-            print(line)
+        return self._h5file
@@ -0,0 +1,74 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .pylion import Simulation, SimulationError
+
+
+def _runsweep(args):
+    builder, index, params, directory = args
+
+    # forked workers share the random state of the parent so ion clouds
+    # would come out the same in every run
+    np.random.seed()
+
+    scratch = tempfile.mkdtemp(prefix=f'run{index:d}-', dir=directory)
+    os.chdir(scratch)
+    try:
+        s = builder(**params)
+        if not isinstance(s, Simulation):
+            raise TypeError("'builder' should return a Simulation.")
+        s.execute()
+    except Exception as e:
+        raise SimulationError(f'Run {index:d} with {params} failed. '
+                              f'Its files are kept in {scratch}.') from e
+
+    name = s.attrs['name']
+    h5file = os.path.join(directory, f'{name}_{index:d}.h5')
+    shutil.move(name + '.h5', h5file)
+
+    os.chdir(directory)
+    shutil.rmtree(scratch)
+
+    return h5file
+
+
+def sweep(builder, params, workers=1, directory='.'):
+    """Runs a simulation for every set of parameters in a pool of processes.
+    ``builder(**p)`` is called with each dict ``p`` in ``params`` and
+    should return a ``Simulation`` that has not executed yet. Every run
+    happens in its own scratch directory so the lammps input, log and
+    dump files of different runs never clash. The h5 file of each run is
+    moved to ``directory`` as ``<name>_<index>.h5`` and the scratch
+    directory is deleted.
+
+    ``builder`` has to be a module level function so that it can be sent
+    to the worker processes, and the lammps executable should be on the
+    path or given as an absolute path.
+
+    Example:
+
+    >>> def builder(voltage):
+    ...     s = Simulation('trap')
+    ...     ...
+    ...     return s
+    >>> h5files = sweep(builder, [{'voltage': v} for v in [100, 200]], 2)
+
+    :param builder: function that returns a Simulation for some parameters
+    :param params: list of dicts with keyword arguments for builder
+    :param workers: number of simulations running at the same time
+    :param directory: where the h5 files are collected
+    :return: list of the h5 files in the order of params.
+    """
+
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+
+    tasks = [(builder, index, p, directory) for index, p in enumerate(params)]
+
+    # a fresh process for every run so that no state leaks between them
+    with multiprocessing.Pool(workers, maxtasksperchild=1) as pool:
+        return pool.map(_runsweep, tasks, chunksize=1)
@@ -3,7 +3,11 @@ import os
 import sys
 import warnings
 import functools
+import hashlib
+import re
+import subprocess
 import h5py
+import numpy as np
 from termcolor import colored
 
 
@@ -40,11 +44,35 @@ def validate_id(func):
 
 
 def _unique_id(*args):
-    # extract 2 least significant bytes. that should be enough to make sure ids
-    # are unique and it's sensitive to small changes in the input arguments
-    uid = sum([id(arg) for arg in args])
-    # uid &= 0xFFF
-    return uid
+    # hash the contents of the arguments so that the same call gives the
+    # same uid in every session and the input file is reproducible
+    digest = hashlib.sha1()
+    for arg in args:
+        _hashupdate(digest, arg)
+
+    # 12 hex digits are plenty to keep uids apart in a simulation
+    return int(digest.hexdigest()[:12], 16)
+
+
+def _hashupdate(digest, arg):
+    if isinstance(arg, dict):
+        digest.update(b'dict')
+        for key in sorted(arg, key=repr):
+            _hashupdate(digest, key)
+            _hashupdate(digest, arg[key])
+    elif isinstance(arg, (list, tuple)):
+        digest.update(type(arg).__name__.encode())
+        for item in arg:
+            _hashupdate(digest, item)
+    elif isinstance(arg, np.ndarray):
+        digest.update(f'{arg.dtype}{arg.shape}'.encode())
+        digest.update(np.ascontiguousarray(arg).tobytes())
+    elif callable(arg):
+        # functions have their memory address in their repr
+        name = getattr(arg, '__qualname__', type(arg).__qualname__)
+        digest.update(f'{arg.__module__}.{name}'.encode())
+    else:
+        digest.update(repr(arg).encode())
 
 
 def save_atttributes_and_files(func):
@@ -54,38 +82,308 @@ def save_atttributes_and_files(func):
 
         # this decorator is only for execute() so that first argument is self
         self = args[0]
-        attrs = self.attrs
+        _saveattributesandfiles(self.attrs, data=getattr(self, '_data', None))
+
+    return wrapper
 
-        # save everything at the end so if the simulation fails the h5file is
-        # not even created
 
-        # initalise the h5 file
-        with h5py.File(attrs['name'] + '.h5', 'w') as f:
-            pass
+def _saveattributesandfiles(attrs, depth=5, data=None):
+    # save everything at the end so if the simulation fails the h5file is
+    # not even created
 
-        # save attrs and scripts to h5 file
-        attrs.save(attrs['name'] + '.h5')
-        _savecallersource(attrs['name'] + '.h5')
+    # initalise the h5 file
+    with h5py.File(attrs['name'] + '.h5', 'w') as f:
+        pass
 
-        for filename in (attrs['output_files']
-                         + ['log.lammps', attrs['name'] + '.lammps']):
-            _savescriptsource(attrs['name'] + '.h5', filename)
+    # save attrs, data collected from the output and scripts to h5 file
+    attrs.save(attrs['name'] + '.h5')
+    with h5py.File(attrs['name'] + '.h5', 'a') as f:
+        for name, values in (data or {}).items():
+            f.create_dataset(name, data=values)
+    _savecallersource(attrs['name'] + '.h5', depth)
 
-    return wrapper
+    scripts = [attrs['log'], attrs['name'] + '.lammps']
+    # the ions are placed from a data file
+    if os.path.exists(attrs['name'] + '.data'):
+        scripts.append(attrs['name'] + '.data')
+    # the script that ran if it started from a restart file
+    if attrs.get('script', scripts[1]) != scripts[1]:
+        scripts.append(attrs['script'])
+
+    for filename in attrs['output_files'] + scripts:
+        _savescriptsource(attrs['name'] + '.h5', filename)
+
+
+@functools.lru_cache()
+def _lammpshelp(executable):
+    return subprocess.run([executable, '-h'], capture_output=True,
+                          text=True).stdout
+
+
+def _installedpackages(executable):
+    """Returns the packages lammps was built with as listed by ``lmp -h``.
+    """
+
+    _, _, packages = _lammpshelp(executable).partition('Installed packages:')
+
+    # the names are in the first paragraph after the title
+    return set(packages.strip().split('\n\n')[0].split())
+
+
+def _lammpsversion(executable):
+    """Returns the version of lammps as listed by ``lmp -h``, e.g.
+    '22 Jul 2025 - Update 4', with the git info of the build if it has any.
+    """
+
+    output = _lammpshelp(executable)
+    match = re.search(r'Simulator - (.+)', output)
+    if match is None:
+        raise ValueError(f"Could not find the version of '{executable}'.")
+    version = match.group(1).strip()
+
+    git = re.search(r'^Git info (.+)$', output, re.MULTILINE)
+    if git:
+        version += ' ' + git.group(1).strip()
+
+    return version
+
+
+def _writedata(filename, species, domain):
+    """Writes the ions of all species to a lammps data file, with their
+    velocities if any species has them.
+    """
+
+    positions = [np.asarray(ions['positions'], dtype=float).reshape(-1, 3)
+                 for ions in species]
+    counts = [len(p) for p in positions]
+    total = sum(counts)
+
+    ids = np.arange(1, total + 1)
+    types = np.repeat([ions['uid'] for ions in species], counts)
+    charges = np.repeat([1.60217646*10**(-19) * ions['charge']
+                         for ions in species], counts)
+
+    with open(filename, 'w') as f:
+        f.write('LAMMPS data file written by pylion\n\n'
+                f'{total} atoms\n{len(species)} atom types\n\n')
+        for length, axis in zip(domain, 'xyz'):
+            f.write(f'{-length!r} {length!r} {axis}lo {axis}hi\n')
+
+        f.write('\nAtoms # charge\n\n')
+        atoms = np.column_stack([ids, types, charges,
+                                 np.concatenate(positions)])
+        # savetxt formats row by row without building the whole file
+        np.savetxt(f, atoms, fmt='%d %d %.17g %.17g %.17g %.17g')
+
+        if any(ions.get('velocities') is not None for ions in species):
+            velocities = [np.zeros((n, 3)) if ions.get('velocities') is None
+                          else np.asarray(ions['velocities'],
+                                          dtype=float).reshape(n, 3)
+                          for ions, n in zip(species, counts)]
+            f.write('\nVelocities\n\n')
+            np.savetxt(f, np.column_stack([ids, np.concatenate(velocities)]),
+                       fmt='%d %.17g %.17g %.17g')
+
+
+def _closepairs(points, distance):
+    """Finds the pairs of points that are closer than distance.
+
+    :return: two arrays with the indices i < j of each pair.
+    """
+
+    return _CellGrid(points, distance).pairs()
+
+
+class _CellGrid:
+    """Sorts points into cells at least ``distance`` wide so that points
+    closer than that are in the same or neighbouring cells. The cells are
+    sorted by their index and then the three cells of a column along z are
+    next to each other.
+    """
+
+    def __init__(self, points, distance):
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.distance = distance
+
+        # few enough cells that their index fits in an integer
+        if len(points):
+            self.lower = points.min(axis=0)
+            extent = np.ptp(points, axis=0)
+        else:
+            self.lower, extent = np.zeros(3), np.zeros(3)
+        self.size = np.maximum(distance, extent / 2**20)
+        self.dims = [int(length // size) + 3
+                     for length, size in zip(extent, self.size)]
+
+        keys = self._keys(points)
+        self.order = np.argsort(keys)
+        self.keys = keys[self.order]
+        self.sorted = points[self.order]
+
+    def add(self, points):
+        """Adds points to the grid without sorting it again. They are
+        numbered after the points already in it.
+        """
+
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        keys = self._keys(points)
+        order = np.argsort(keys)
+        where = np.searchsorted(self.keys, keys[order])
+
+        self.order = np.insert(self.order, where, order + len(self.order))
+        self.keys = np.insert(self.keys, where, keys[order])
+        self.sorted = np.insert(self.sorted, where, points[order], axis=0)
+
+    def remove(self, indices):
+        """Removes points from the grid. The points after them are
+        numbered again.
+        """
+
+        gone = np.zeros(len(self.order), dtype=bool)
+        gone[indices] = True
+        stay = ~gone[self.order]
+
+        self.order = (np.cumsum(~gone) - 1)[self.order[stay]]
+        self.keys = self.keys[stay]
+        self.sorted = self.sorted[stay]
+
+    def _keys(self, points):
+        # points outside the grid go to the cells at its edges, which keeps
+        # close points in neighbouring cells. The cells around the grid
+        # stay empty.
+        cells = [np.clip(np.floor((points[:, axis] - self.lower[axis])
+                                  / self.size[axis]), 0, self.dims[axis] - 3)
+                 .astype(np.int64) + 1 for axis in range(3)]
+        return (cells[0] * self.dims[1] + cells[1]) * self.dims[2] + cells[2]
+
+    def pairs(self):
+        """Finds the pairs of points of the grid that are closer than the
+        distance.
+
+        :return: two arrays with the indices i < j of each pair.
+        """
+
+        # half of the neighbouring columns are enough since each pair of
+        # columns is then seen once. In its own column a point only looks
+        # at the ones after it.
+        queries = np.arange(len(self.keys))
+        first, second = [], []
+        for dx, dy in [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)]:
+            neighbours = self.keys + (dx * self.dims[1] + dy) * self.dims[2]
+            if (dx, dy) == (0, 0):
+                lo = queries + 1
+            else:
+                lo = np.searchsorted(self.keys, neighbours - 1, side='left')
+            hi = np.searchsorted(self.keys, neighbours + 1, side='right')
+            i, j = self._close(lo, hi, self.order, self.sorted)
+            first.append(np.minimum(i, j))
+            second.append(np.maximum(i, j))
+
+        return np.concatenate(first), np.concatenate(second)
+
+    def query(self, points):
+        """Finds the pairs of a point of the grid and one of points that are
+        closer than the distance.
+
+        :return: two arrays with the indices in the grid and in points of
+          each pair.
+        """
+
+        # sorted queries make the searches much faster
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        keys = self._keys(points)
+        queries = np.argsort(keys)
+        keys, points = keys[queries], points[queries]
+        first, second = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                neighbours = keys + (dx * self.dims[1] + dy) * self.dims[2]
+                lo = np.searchsorted(self.keys, neighbours - 1, side='left')
+                hi = np.searchsorted(self.keys, neighbours + 1, side='right')
+                i, j = self._close(lo, hi, queries, points)
+                first.append(i)
+                second.append(j)
+
+        return np.concatenate(first), np.concatenate(second)
+
+    def _close(self, lo, hi, queries, points):
+        # the sorted points from lo to hi that are close to each query
+        number = hi - lo
+
+        # most points have no neighbours in most columns. The sorted points
+        # are read in order, which is much faster than the original ones.
+        found = np.flatnonzero(number > 0)
+        lo, number = lo[found], number[found]
+        j = np.repeat(found, number)
+        i = np.arange(len(j)) + np.repeat(lo - np.cumsum(number) + number,
+                                          number)
+        close = (((self.sorted[i] - points[j]) ** 2).sum(axis=1)
+                 < self.distance ** 2)
+
+        return self.order[i[close]], queries[j[close]]
+
+
+def _processorgrid(procs, lengths):
+    # the grid of processors lammps picks for a box, the one with the
+    # smallest surface between subdomains
+    lx, ly, lz = lengths
+    best, grid = None, None
+    for px in range(1, procs + 1):
+        if procs % px:
+            continue
+        for py in range(1, procs // px + 1):
+            if (procs // px) % py:
+                continue
+            pz = procs // px // py
+            surface = (lx * ly / (px * py) + ly * lz / (py * pz)
+                       + lx * lz / (px * pz))
+            if best is None or surface < best:
+                best, grid = surface, (px, py, pz)
+
+    return grid
+
+
+def _imbalance(positions, domain, procs):
+    """Estimates the imbalance factor of the ions when the domain is split
+    in equal bricks, one for each processor. It is the largest number of
+    ions in a brick over the average.
+    """
+
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    if not len(positions):
+        return 1.0
+
+    domain = np.asarray(domain, dtype=float)
+    grid = np.array(_processorgrid(procs, 2 * domain))
+
+    # ions are inside [-domain, domain]
+    index = np.floor((positions + domain) / (2 * domain) * grid).astype(int)
+    index = np.clip(index, 0, grid - 1)
+    counts = np.bincount(np.ravel_multi_index(index.T, grid),
+                         minlength=procs)
+
+    return float(counts.max() * procs / len(positions))
 
 
 def _savescriptsource(h5file, script):
     with h5py.File(h5file, 'a') as f:
         with open(script, 'rb') as pf:
-            lines = pf.readlines()
+            if script.endswith(('.bin', '.gz', '.zst')):
+                # binary and compressed dumps have no lines, keep them byte
+                # for byte
+                lines = np.frombuffer(pf.read(), dtype=np.uint8)
+            else:
+                lines = pf.readlines()
             f.create_dataset(script, data=lines)
 
 
-def _savecallersource(h5file):
+def _savecallersource(h5file, depth=5):
     # inspect the first four frames of the stack to find the correct
     # filename. This covers calling from execute() or _writeinputfile().
     # if the stack is indeed larger than this it's probably the REPL.
-    stack = inspect.stack()[:5]
+    # Coroutines are called from deep in the event loop so they look at
+    # the whole stack with depth=None.
+    stack = inspect.stack()[:depth]
     for frame in stack:
         if sys.argv[0] == frame.filename:
             _savescriptsource(h5file, frame.filename)
@@ -15,7 +15,7 @@ with open('readme.md') as readme_file:
 requirements = [
     'h5py>=2.7.0',
     'termcolor>=1.1.0',
-    'numpy>=1.13.1',
+    'numpy>=1.17',
     'jinja2>=2.9.6',
 ] + expect
 
@@ -80,7 +80,8 @@ def simulation(simulation_data, request):
 
     yield request.param
 
-    filenames = ['log.lammps', f'{name}.h5', f'{name}.lammps', 'positions.txt']
+    filenames = ['log.lammps', f'{name}.h5', f'{name}.lammps',
+                 f'{name}.data', 'positions.txt']
     for filename in filenames:
         os.remove(filename)
 
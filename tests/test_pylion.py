@@ -1,13 +1,22 @@
 import pytest
 import pylion as pl
 from pylion.pylion import SimulationError
+from pylion.utils import _lammpsversion
 import os
+import sys
+import struct
+import subprocess
+import asyncio
+import shutil
+import json
+import h5py
+import numpy as np
 
 
 @pytest.fixture
 def cleanup():
     yield
-    for filename in ['test.h5', 'test.lammps']:
+    for filename in ['test.h5', 'test.lammps', 'test.data']:
         try:
             os.remove(filename)
         except FileNotFoundError:
@@ -65,6 +74,39 @@ def test_sameuids(cleanup):
         s._writeinputfile()
 
 
+def test_speciesuids(cleanup):
+    # species are numbered by the simulation they are appended to
+    a = pl.Simulation('test')
+    a.append(pl.placeions({'charge': 1, 'mass': 40}, [[0, 0, 0]]))
+    b = pl.Simulation('test')
+    b.append(pl.placeions({'charge': 1, 'mass': 9}, [[0, 0, 0]]))
+    a.append(pl.placeions({'charge': 1, 'mass': 9}, [[1e-4, 0, 0]]))
+    a.append(pl.placeions({'charge': 1, 'mass': 40}, [[2e-4, 0, 0]]))
+
+    assert [ions['uid'] for ions in a] == [1, 2, 1]
+    assert b[0]['uid'] == 1
+
+
+def test_fixbeforeappend(cleanup):
+    # a fix cannot name a species before it has a uid
+    s = pl.Simulation('test')
+    ions = pl.placeions({'charge': 1, 'mass': 40}, [[0, 0, 0]])
+    trap = {'radius': 3.75e-3, 'length': 2.75e-3, 'kappa': 0.244,
+            'frequency': 3.85e6, 'voltage': 500, 'endcapvoltage': 15,
+            'pseudo': True}
+    for fix in [lambda: pl.lasercool(ions, [1, 0, 0]),
+                lambda: pl.ionneutralheating(ions, 1e-20),
+                lambda: pl.linearpaultrap(trap, ions, all=False)]:
+        with pytest.raises(SimulationError, match='Append'):
+            fix()
+
+    s.append(ions)
+    s.append(pl.lasercool(ions, [1, 0, 0]))
+    s._writeinputfile()
+    with open('test.lammps') as f:
+        assert f"group {s[1]['uid']} type 1\n" in f.read()
+
+
 def test_returnsdict():
     @pl.lammps.fix
     def fixme(uid):
@@ -148,8 +190,1141 @@ def test_rigid(cleanup):
     assert len(s.attrs['rigid']['groups']) == 2
 
 
+def test_createioncloud():
+    ions = {'mass': 40, 'charge': 1}
+    positions = pl.createioncloud(ions, 1e-3, 20000, seed=1)['positions']
+    assert positions.shape == (20000, 3)
+    again = pl.createioncloud(ions, 1e-3, 20000, seed=1)['positions']
+    assert np.array_equal(positions, again)
+
+    # uniform in volume so an eighth of the ions is in half the radius
+    r = np.linalg.norm(positions, axis=1)
+    assert r.max() <= 1e-3
+    assert np.mean(r < 0.5e-3) == pytest.approx(1 / 8, abs=0.01)
+
+    positions = pl.createioncloud(ions, [1e-4, 2e-4, 1e-3], 1000,
+                                  shape='ellipsoid', seed=2)['positions']
+    assert np.all(((positions / [1e-4, 2e-4, 1e-3]) ** 2).sum(axis=1) <= 1)
+
+    positions = pl.createioncloud(ions, 1e-3, 20000, shape='gaussian',
+                                  seed=3)['positions']
+    assert positions.std(axis=0) == pytest.approx([1e-3] * 3, rel=0.05)
+
+    with pytest.raises(ValueError, match="Unknown shape"):
+        pl.createioncloud(ions, 1e-3, 10, shape='cube')
+    with pytest.raises(ValueError, match="ellipsoid"):
+        pl.createioncloud(ions, [1e-3, 1e-3, 2e-3], 10)
+
+
+def test_createioncloud_separation():
+    ions = {'mass': 40, 'charge': 1}
+    positions = pl.createioncloud(ions, 1e-3, 1000, separation=1e-4,
+                                  seed=4)['positions']
+    distances = np.linalg.norm(positions[:, None] - positions[None], axis=-1)
+    assert distances[np.triu_indices(1000, 1)].min() >= 1e-4
+
+    # without the separation some ions would be closer
+    positions = pl.createioncloud(ions, 1e-3, 1000, seed=4)['positions']
+    distances = np.linalg.norm(positions[:, None] - positions[None], axis=-1)
+    assert distances[np.triu_indices(1000, 1)].min() < 1e-4
+
+    with pytest.raises(ValueError, match='Could not place'):
+        pl.createioncloud(ions, 1e-3, 100, separation=1e-3, seed=4)
+
+
+def test_speciesarrays(cleanup):
+    ions = pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 0], [1e-4, 0, 0]])
+    assert isinstance(ions['positions'], np.ndarray)
+    assert ions['positions'].shape == (2, 3)
+    assert ions['positions'].flags['C_CONTIGUOUS']
+
+    # arrays of floats are not copied on the way to the simulation
+    s = pl.Simulation('test')
+    positions = np.zeros((1000, 3))
+    ions = pl.placeions({'mass': 40, 'charge': 1}, positions,
+                        velocities=np.ones(3000))
+    assert ions['velocities'].shape == (1000, 3)
+    s.append(ions)
+    assert s[0]['positions'] is ions['positions']
+    assert np.shares_memory(s[0]['positions'], positions)
+
+    s._writeinputfile()
+    with open('test.lammps') as f:
+        assert len(f.read().splitlines()) < 100
+
+    with pytest.raises(ValueError, match='velocity for each ion'):
+        pl.placeions({'mass': 40, 'charge': 1}, positions,
+                     velocities=[[0, 0, 0]])
+
+
+def test_templatecache(monkeypatch, cleanup):
+    from pylion.pylion import _template
+
+    template = _template('simulation.j2')
+    assert _template('simulation.j2') is template
+
+    s = pl.Simulation('test')
+    s.append(pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 0]]))
+    s.append(pl.evolve(10))
+    s._writeinputfile()
+    with open('test.lammps') as f:
+        assert f.read().endswith('run 10\n\n')
+
+    # templates that change on disk are compiled again
+    monkeypatch.setattr(os.path, 'getmtime', lambda filename: 0)
+    assert _template('simulation.j2') is not template
+
+
+def test_closepairs():
+    from pylion.utils import _CellGrid, _closepairs
+
+    points = np.random.default_rng(5).normal(size=(1000, 3)) * [1, 1, 5]
+    distances = np.linalg.norm(points[:, None] - points[None], axis=-1)
+    i, j = np.triu_indices(1000, 1)
+    close = distances[i, j] < 0.1
+    assert set(zip(*_closepairs(points, 0.1))) == set(zip(i[close], j[close]))
+
+    # the later points against a grid of the first 800, some of them
+    # outside the grid
+    grid = _CellGrid(points[:500], 0.1)
+    grid.add(points[500:800])
+    i, j = np.nonzero(distances[:800, 800:] < 0.1)
+    assert set(zip(*grid.query(points[800:]))) == set(zip(i, j))
+
+    grid.remove(np.arange(100))
+    i, j = np.nonzero(distances[100:800, 800:] < 0.1)
+    assert set(zip(*grid.query(points[800:]))) == set(zip(i, j))
+
+
 def test_variables():
     # test passes even without 'variables' arg
     @pl.lammps.variable('fix')
     def variable(uid):
         return {}
+
+
+def _writedump(filename, frames, shuffle=False):
+    # frames has shape (steps, ions, (x, y, z)) and ids start from 1
+    ions = frames.shape[1]
+    rng = np.random.default_rng(2)
+    with open(filename, 'w') as f:
+        for step, frame in enumerate(frames):
+            order = rng.permutation(ions) if shuffle else range(ions)
+            f.write(f'ITEM: TIMESTEP\n{10 * step}\n'
+                    f'ITEM: NUMBER OF ATOMS\n{ions}\n'
+                    'ITEM: BOX BOUNDS mm mm mm\n' + '-1e-3 1e-3\n' * 3 +
+                    'ITEM: ATOMS id x y z\n')
+            for i in order:
+                coordinates = ' '.join(map(repr, frame[i].tolist()))
+                f.write(f'{i + 1} {coordinates} \n')
+
+
+@pytest.fixture
+def frames():
+    return np.random.default_rng(1).normal(size=(25, 7, 3))
+
+
+def test_readdump(frames, tmp_path):
+    filename = tmp_path / 'positions.txt'
+    _writedump(filename, frames)
+
+    steps, data = pl.readdump(filename)
+    assert np.array_equal(steps, 10 * np.arange(len(frames)))
+    assert np.array_equal(data, frames)
+
+
+def test_readdump_blocks(frames, tmp_path, monkeypatch):
+    # force the parser to go through the file a few frames at a time
+    monkeypatch.setattr(pl.dumps, '_BLOCKSIZE', 1000)
+    filename = tmp_path / 'positions.txt'
+    _writedump(filename, frames)
+
+    _, data = pl.readdump(filename)
+    assert np.array_equal(data, frames)
+
+
+def test_readdump_noid(tmp_path):
+    filename = tmp_path / 'positions.txt'
+    with open(filename, 'w') as f:
+        f.write('ITEM: TIMESTEP\n0\nITEM: NUMBER OF ATOMS\n1\n'
+                'ITEM: ATOMS x y z\n0 0 0\n')
+
+    with pytest.raises(TypeError, match="should be 'id'"):
+        pl.readdump(filename)
+
+
+@pytest.mark.parametrize('chunk', [1, 4, 25, 100])
+def test_iterdump(chunk, frames, tmp_path, monkeypatch):
+    # small reads so that frames are split across them
+    monkeypatch.setattr(pl.dumps, '_BLOCKSIZE', 1000)
+    filename = tmp_path / 'positions.txt'
+    _writedump(filename, frames)
+
+    blocks = list(pl.iterdump(filename, chunk=chunk))
+    assert all(len(data) == chunk for _, data in blocks[:-1])
+
+    steps = np.concatenate([steps for steps, _ in blocks])
+    data = np.concatenate([data for _, data in blocks])
+    assert np.array_equal(steps, 10 * np.arange(len(frames)))
+    assert np.array_equal(data, frames)
+
+
+def test_readdump_frames(frames, tmp_path):
+    filename = tmp_path / 'positions.txt'
+    _writedump(filename, frames)
+
+    steps, data = pl.readdump(filename, frames=slice(-1, None))
+    assert np.array_equal(steps, [240])
+    assert np.array_equal(data, frames[-1:])
+
+    _, data = pl.readdump(filename, frames=slice(3, None, 5))
+    assert np.array_equal(data, frames[3::5])
+
+    steps, data = pl.readdump(filename, frames=[50, 0, 120])
+    assert np.array_equal(steps, [50, 0, 120])
+    assert np.array_equal(data, frames[[5, 0, 12]])
+
+    with pytest.raises(ValueError, match='Timestep 55'):
+        pl.readdump(filename, frames=[55])
+
+
+def test_readdump_index(frames, tmp_path, monkeypatch):
+    monkeypatch.setattr(pl.dumps, '_INDEXSIZE', 0)
+    filename = tmp_path / 'positions.txt'
+    _writedump(filename, frames)
+
+    _, data = pl.readdump(filename, frames=slice(-1, None))
+    assert os.path.exists(f'{filename}.idx')
+    assert np.array_equal(data, frames[-1:])
+
+    # the stale index is rebuilt when the file changes
+    _writedump(filename, frames[:10])
+    _, data = pl.readdump(filename, frames=slice(-1, None))
+    assert np.array_equal(data, frames[9:10])
+
+
+def test_readdump_workers(frames, tmp_path):
+    filename = tmp_path / 'positions.txt'
+    _writedump(filename, frames)
+
+    steps, data = pl.readdump(filename, frames=slice(2, None), workers=3)
+    assert np.array_equal(steps, 10 * np.arange(2, len(frames)))
+    assert np.array_equal(data, frames[2:])
+    # the frames stay in the shared memory the workers wrote them to
+    assert not data.flags['OWNDATA']
+
+    _, data = pl.readdump(filename, ions=slice(1, 4), columns=['z'],
+                          workers=2)
+    assert np.array_equal(data, frames[:, 1:4, 2:])
+
+
+def _writebinarydump(filename, frames, chunks=2):
+    # mimics the revision 2 binary format of 'dump custom' split in chunks
+    # like an mpi run would write it
+    ions = frames.shape[1]
+    columns = b'id x y z'
+    with open(filename, 'wb') as f:
+        for step, frame in enumerate(frames):
+            f.write(struct.pack('=q', -10) + b'DUMPCUSTOM')
+            f.write(struct.pack('=iiqqi', 1, 2, 10 * step, ions, 0))
+            f.write(struct.pack('=6i6d', *[2] * 6, *[-1e-3, 1e-3] * 3))
+            f.write(struct.pack('=iibi', 4, 0, 0, len(columns)) + columns)
+            f.write(struct.pack('=i', chunks))
+            values = np.column_stack([np.arange(1, ions + 1), frame])
+            for block in np.array_split(values, chunks):
+                f.write(struct.pack('=i', block.size) + block.tobytes())
+
+
+def test_readdump_binary(frames, tmp_path):
+    filename = str(tmp_path / 'positions.bin')
+    _writebinarydump(filename, frames)
+
+    steps, data = pl.readdump(filename)
+    assert np.array_equal(steps, 10 * np.arange(len(frames)))
+    assert np.array_equal(data, frames)
+
+    steps, data = pl.readdump(filename, frames=[20, 10])
+    assert np.array_equal(data, frames[[2, 1]])
+
+    data = np.concatenate([d for _, d in pl.iterdump(filename, chunk=4)])
+    assert np.array_equal(data, frames)
+
+
+def test_convertdump(frames, tmp_path):
+    filename = str(tmp_path / 'positions.txt')
+    _writedump(filename, frames)
+
+    output = pl.convertdump(filename, chunk=4)
+    assert output == str(tmp_path / 'positions.h5')
+
+    steps, data = pl.readdump(output)
+    assert isinstance(data, np.memmap)
+    assert np.array_equal(steps, 10 * np.arange(len(frames)))
+    assert np.array_equal(data, frames)
+
+    _, data = pl.readdump(output, frames=slice(-1, None))
+    assert isinstance(data, np.memmap)
+    assert np.array_equal(data, frames[-1:])
+
+
+def test_binarydump():
+    lines = pl.dump('positions.txt', variables=['x'], binary=True)['code']
+    assert lines[-1].split()[5] == 'positions.txt.bin'
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_readdump_compressed(compression, frames, tmp_path, monkeypatch):
+    monkeypatch.setattr(pl.dumps, '_BLOCKSIZE', 1000)
+    filename = tmp_path / 'positions.txt'
+    _writedump(filename, frames)
+    with open(filename, 'rb') as f:
+        raw = f.read()
+
+    if compression == 'gzip':
+        import gzip
+        compressed = gzip.compress(raw)
+    else:
+        zstandard = pytest.importorskip('zstandard')
+        compressed = zstandard.ZstdCompressor().compress(raw)
+
+    filename = str(filename) + '.compressed'
+    with open(filename, 'wb') as f:
+        f.write(compressed)
+
+    steps, data = pl.readdump(filename)
+    assert np.array_equal(steps, 10 * np.arange(len(frames)))
+    assert np.array_equal(data, frames)
+
+    _, data = pl.readdump(filename, frames=slice(-1, None))
+    assert np.array_equal(data, frames[-1:])
+
+    # frames from different blocks in any order
+    steps, data = pl.readdump(filename, frames=[200, 0, 40, 200])
+    assert list(steps) == [200, 0, 40, 200]
+    assert np.array_equal(data, frames[[20, 0, 4, 20]])
+
+    _, data = pl.readdump(pl.convertdump(filename, chunk=4))
+    assert np.array_equal(data, frames)
+
+
+def test_compresseddump():
+    lines = pl.dump('positions.txt', variables=['x'], compression='zstd')
+    assert lines['code'][-1].split()[3:6] == ['custom/zstd', '10',
+                                              'positions.txt.zst']
+
+    with pytest.raises(ValueError, match='cannot be compressed'):
+        pl.dump('positions.txt', variables=['x'], binary=True,
+                compression='gz')
+
+
+@pytest.mark.parametrize('kind', ['text', 'binary', 'trajectory'])
+def test_readdump_selection(kind, frames, tmp_path):
+    filename = str(tmp_path / 'positions.txt')
+    _writedump(filename, frames)
+    if kind == 'binary':
+        filename = str(tmp_path / 'positions.bin')
+        _writebinarydump(filename, frames)
+    elif kind == 'trajectory':
+        filename = pl.convertdump(filename)
+
+    steps, data = pl.readdump(filename, columns=['z', 'x'])
+    assert np.array_equal(data, frames[..., [2, 0]])
+
+    _, data = pl.readdump(filename, ions=slice(2, 5))
+    assert np.array_equal(data, frames[:, 2:5])
+
+    _, data = pl.readdump(filename, ions=[5, 1, 3], columns=['y'])
+    assert np.array_equal(data, frames[:, [5, 1, 3]][..., [1]])
+
+    steps, data = pl.readdump(filename, step_stride=3, steps=(20, 200))
+    assert np.array_equal(steps, np.arange(20, 200, 30))
+    assert np.array_equal(data, frames[2:20:3])
+
+    if kind != 'trajectory':
+        _, data = pl.readdump(filename, ids=[7, 1])
+        assert np.array_equal(data, frames[:, [6, 0]])
+
+    with pytest.raises(ValueError, match="'vx'"):
+        pl.readdump(filename, columns=['vx'])
+
+
+def test_readdump_sort(frames, tmp_path):
+    # lammps does not keep atoms in order, especially with mpi
+    filename = tmp_path / 'positions.txt'
+    _writedump(filename, frames, shuffle=True)
+
+    _, data = pl.readdump(filename)
+    assert np.array_equal(data, frames)
+
+    _, data = pl.readdump(filename, ions=[3, 1], columns=['y'])
+    assert np.array_equal(data, frames[:, [3, 1], 1:2])
+
+    _, data, ids = pl.readdump(filename, return_ids=True)
+    assert np.array_equal(ids, np.arange(1, 8))
+
+    _, data, ids = pl.readdump(filename, sort=False, return_ids=True)
+    assert ids.shape == frames.shape[:2]
+    assert np.array_equal(data,
+                          frames[np.arange(len(frames))[:, None], ids - 1])
+
+    data = np.concatenate([d for _, d in pl.iterdump(filename, chunk=4)])
+    assert np.array_equal(data, frames)
+
+
+def test_dumptail(frames, tmp_path):
+    filename = tmp_path / 'positions.txt'
+    _writedump(tmp_path / 'full.txt', frames)
+    with open(tmp_path / 'full.txt', 'rb') as f:
+        raw = f.read()
+
+    tail = pl.DumpTail(filename)
+    steps, data = tail.poll()
+    assert not len(steps)
+
+    # lammps writes the dump in pieces that can end anywhere
+    received = []
+    with open(filename, 'wb') as f:
+        for start in range(0, len(raw), 1234):
+            f.write(raw[start:start + 1234])
+            f.flush()
+            steps, data = tail.poll()
+            received.append(data)
+
+    data = np.concatenate(received)
+    assert np.array_equal(data, frames)
+    assert tail.position == len(raw)
+
+
+def test_dumptail_thread(frames, tmp_path):
+    filename = tmp_path / 'positions.txt'
+    received = []
+
+    def callback(steps, data):
+        received.append(data)
+
+    with pl.DumpTail(filename, callback, interval=0.01):
+        _writedump(filename, frames)
+
+    assert np.array_equal(np.concatenate(received), frames)
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='needs named pipes')
+def test_dumpstream(frames, tmp_path):
+    filename = tmp_path / 'positions.fifo'
+    received = []
+
+    def callback(steps, data):
+        received.append(data)
+
+    stream = pl.DumpStream(capacity=10, callback=callback)
+    stream.open(filename)
+    # lammps writes to the pipe as if it was a file
+    _writedump(filename, frames)
+    stream.close()
+
+    assert not os.path.exists(filename)
+    assert np.array_equal(np.concatenate(received), frames)
+    steps, data = stream.frames()
+    assert np.array_equal(steps, 10 * np.arange(15, 25))
+    assert np.array_equal(data, frames[-10:])
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='needs named pipes')
+def test_dumpstream_unopened(tmp_path):
+    # lammps may fail before it opens the pipe
+    stream = pl.DumpStream()
+    stream.open(tmp_path / 'positions.fifo')
+    stream.close()
+    steps, data = stream.frames()
+    assert not len(steps)
+
+
+def test_dumpstream_files(cleanup):
+    s = pl.Simulation('test')
+    ions = pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 0]])
+    ions['uid'] = 1
+    s.append(ions)
+    s.append(pl.dump('positions.txt', ['x', 'y', 'z']))
+    s.append(pl.dump('velocities.txt', ['vx', 'vy', 'vz'],
+                     stream=pl.DumpStream()))
+    s._writeinputfile()
+    assert s.attrs['output_files'] == ['positions.txt']
+    assert list(s._streams) == ['velocities.txt']
+
+    with pytest.raises(ValueError):
+        pl.dump('positions', ['x'], binary=True, stream=pl.DumpStream())
+
+
+def test_datafile(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    s = pl.Simulation('test')
+    s.append(pl.placeions({'mass': 40, 'charge': 1},
+                          [[0, 0, 0], [1e-4, 0, 0]]))
+    s.append(pl.placeions({'mass': 9, 'charge': 2}, [[0, 1e-4, 0]],
+                          velocities=[[1, 2, 3]]))
+    s._writeinputfile()
+
+    with open('test.lammps') as f:
+        script = f.read()
+    assert 'create_atoms' not in script
+    assert 'read_data test.data add append\n' in script
+
+    with open('test.data') as f:
+        data = f.read()
+    assert '3 atoms\n2 atom types\n' in data
+    atoms = data.split('Atoms # charge\n\n')[1].split('\n\n')[0]
+    atoms = np.loadtxt(atoms.splitlines())
+    assert list(atoms[:, 0]) == [1, 2, 3] and list(atoms[:, 1]) == [1, 1, 2]
+    assert atoms[2, 2] == pytest.approx(2 * 1.60217646e-19)
+    assert list(atoms[1, 3:]) == [1e-4, 0, 0]
+    velocities = np.loadtxt(data.split('Velocities\n\n')[1].splitlines())
+    assert list(velocities[:, 1:].ravel()) == [0] * 6 + [1, 2, 3]
+
+    # the script changes with the ions
+    s = pl.Simulation('test')
+    s.append(pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 1e-4]]))
+    s._writeinputfile()
+    with open('test.lammps') as f:
+        assert f.read() != script
+
+    s = pl.Simulation('test')
+    s.append(pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 1]]))
+    with pytest.raises(SimulationError, match='outside the simulation'):
+        s._writeinputfile()
+
+
+class _FakeLammps:
+    # records the commands instead of running them
+    def __init__(self, cmdargs):
+        self.commands = []
+        self.natoms = 0
+        open(cmdargs[cmdargs.index('-log') + 1], 'w').close()
+
+    def command(self, line):
+        self.commands.append(line)
+        if line.startswith('read_data'):
+            with open(line.split()[1]) as f:
+                self.natoms += int(f.read().split('\n')[2].split()[0])
+
+    def extract_global(self, name):
+        return 0
+
+    def close(self):
+        pass
+
+
+def test_librarybackend(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    s = pl.Simulation('test')
+    with pytest.raises(SimulationError, match="'library' backend"):
+        s.execute(callback=print)
+
+    lmp = _FakeLammps(['-log', 'log.lammps'])
+    module = type(sys)('lammps')
+    module.lammps = lambda cmdargs: lmp
+    monkeypatch.setitem(sys.modules, 'lammps', module)
+
+    ions = pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 0], [1e-4, 0, 0]])
+    ions['uid'] = 1
+    s.append(ions)
+    s.append(pl.evolve(2500))
+    s.attrs['backend'] = 'library'
+    with pytest.raises(SimulationError, match='pexpect'):
+        s.execute(quiet=True)
+
+    calls = []
+    s.execute(callback=calls.append, every=1000)
+    assert calls == [s] * 3
+    assert lmp.natoms == 2
+    assert lmp.commands[-3:] == [
+        'run 1000 start 0 stop 2500 pre yes post no',
+        'run 1000 start 0 stop 2500 pre no post no',
+        'run 500 start 0 stop 2500 pre no post yes']
+
+
+_FAKELAMMPS = '''#!{python}
+# prints the help and writes the log and the dumps of the input file like
+# lammps would. Only the first rank writes output.
+import os, sys, time
+args = sys.argv[1:]
+if args == ['-h']:
+    print('Large-scale Atomic/Molecular Massively Parallel Simulator - '
+          '22 Jul 2025 - Update 4\\n'
+          'Git info (stable / stable_22Jul2025_update4)\\n\\n'
+          'Installed packages:\\n\\nKSPACE MOLECULE OPENMP RIGID \\n\\n'
+          'List of individual style options included in this LAMMPS '
+          'executable')
+    sys.exit()
+if os.environ.get('OMPI_COMM_WORLD_RANK', '0') != '0':
+    sys.exit()
+script = open(args[args.index('-in') + 1]).read()
+log = args[args.index('-log') + 1]
+if log != 'none':
+    open(log, 'w').write(script)
+# dumps are written anew unless they are appended to
+lines = [line.split() for line in script.splitlines()]
+appended = [words[1] for words in lines if words[:1] == ['dump_modify']]
+for words in lines:
+    if words[:1] == ['dump'] and words[1] not in appended:
+        open(words[5], 'w').write('ITEM: TIMESTEP\\n0\\n')
+'''
+
+
+@pytest.fixture
+def fakelammps(tmp_path):
+    # writes a fake lammps that does what is specific to a test in body
+    def write(body='', **values):
+        executable = tmp_path / 'lmp'
+        executable.write_text((_FAKELAMMPS + body).format(
+            python=sys.executable, **values))
+        executable.chmod(0o755)
+        return executable
+
+    return write
+
+
+def _sweepbuilder(executable, radius):
+    s = pl.Simulation('sweep')
+    s.attrs['executable'] = executable
+    s.append(pl.createioncloud({'mass': 40, 'charge': 1}, radius, 5))
+    s.append(pl.dump('positions.txt', ['x', 'y', 'z']))
+    return s
+
+
+def test_sweep(fakelammps, tmp_path):
+    executable = fakelammps()
+
+    params = [{'executable': str(executable), 'radius': r}
+              for r in [1e-4, 2e-4, 3e-4]]
+    h5files = pl.sweep(_sweepbuilder, params, workers=2, directory=tmp_path)
+    assert h5files == [str(tmp_path / f'sweep_{i}.h5') for i in range(3)]
+    # only the collected h5 files and the executable are left
+    assert sorted(os.listdir(tmp_path)) == ['lmp'] + [
+        f'sweep_{i}.h5' for i in range(3)]
+
+    logs = []
+    for h5file, p in zip(h5files, params):
+        with h5py.File(h5file, 'r') as f:
+            assert 'positions.txt' in f
+            assert json.loads(f.attrs['executable']) == p['executable']
+            logs.append(b''.join(f['log.lammps'][:]).decode())
+
+    # every run has its own species registry and random ions
+    assert all('create_box 1' in log for log in logs)
+    assert len(set(logs)) == len(logs)
+
+
+def test_mpicommand():
+    s = pl.Simulation('test')
+    assert s._command() == ['lmp', '-in', 'test.lammps', '-log', 'log.lammps']
+
+    s.attrs['mpi'] = {'np': 4, 'args': ['--bind-to', 'core']}
+    assert s._command() == ['mpirun', '-n', '4', '--bind-to', 'core',
+                            'lmp', '-in', 'test.lammps', '-log', 'log.lammps']
+
+    s.attrs['backend'] = 'library'
+    with pytest.raises(SimulationError, match='mpi'):
+        s.execute()
+
+
+@pytest.mark.skipif(shutil.which('mpirun') is None, reason='needs mpirun')
+def test_mpiexecute(monkeypatch, tmp_path, fakelammps):
+    monkeypatch.chdir(tmp_path)
+    executable = fakelammps('''
+open(log, 'w').write(os.environ['OMPI_COMM_WORLD_SIZE'])
+print('Created 1 atoms')
+print('Total wall time: 0:00:00')
+''')
+
+    s = pl.Simulation('test')
+    s.attrs['executable'] = str(executable)
+    s.attrs['mpi'] = {'np': 2, 'launcher': 'mpirun',
+                      'args': ['--oversubscribe', '--allow-run-as-root']}
+    s.append(pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 0]]))
+    s.execute()
+
+    with h5py.File('test.h5', 'r') as f:
+        assert f['log.lammps'][:].tolist() == [b'2']
+
+
+def test_balance(cleanup):
+    s = pl.Simulation('test')
+    s.attrs['mpi'] = {'np': 8}
+
+    # uniform ions are balanced by a plain spatial split
+    rng = np.random.default_rng(3)
+    uniform = rng.uniform(-1e-3, 1e-3, size=(8000, 3))
+    s.append(pl.placeions({'mass': 40, 'charge': 1}, uniform.tolist()))
+    s._writeinputfile()
+    assert s.attrs['balance']['predicted'] < 1.1
+    with open('test.lammps') as f:
+        assert 'comm_style tiled' not in f.read()
+
+    # a dense cloud in the middle is not
+    s = pl.Simulation('test')
+    s.attrs['mpi'] = {'np': 27}
+    dense = rng.normal(scale=2e-4, size=(1000, 3))
+    s.append(pl.placeions({'mass': 40, 'charge': 1}, dense.tolist()))
+    s._writeinputfile()
+    assert s.attrs['balance']['predicted'] > 1.5
+    with open('test.lammps') as f:
+        script = f.read()
+    assert 'comm_style tiled\nbalance 1.1 rcb\n' in script
+    assert 'fix pylionBalance all balance 1000 1.1 rcb' in script
+
+    # the factors lammps prints are kept
+    s._process_stdout(['  initial/final imbalance factor = 7.32 1.004\n'])
+    assert s.attrs['balance']['imbalance'] == [7.32, 1.004]
+
+
+def test_acceleration(cleanup, fakelammps):
+    executable = fakelammps()
+
+    s = pl.Simulation('test')
+    s.attrs['executable'] = str(executable)
+    s.attrs['acceleration'] = {'package': 'omp', 'threads': 4}
+    s.append(pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 0]]))
+    s._writeinputfile()
+    with open('test.lammps') as f:
+        assert 'package omp 4\nsuffix omp\n' in f.read()
+
+    s.attrs['acceleration'] = {'package': 'intel'}
+    with pytest.raises(SimulationError, match='INTEL'):
+        s._writeinputfile()
+
+    s.attrs['acceleration'] = {'package': 'kokkos'}
+    with pytest.raises(SimulationError, match='Unknown'):
+        s._writeinputfile()
+
+
+_THERMO = '''
+# prints thermo output like lammps would during a run
+print('Created 1 atoms', flush=True)
+print('  using box units', flush=True)
+print('   Step          CPU    ', flush=True)
+for step in range(0, 1001, 250):
+    print(f'{{step:8d}} {{step / 1e4:12.6f}}', flush=True)
+    if step == 250:
+        time.sleep({delay})
+print('Loop time of 0.1 on 1 procs for 1000 steps', flush=True)
+'''
+
+
+def _asyncsimulation(fakelammps, delay):
+    executable = fakelammps(_THERMO, delay=delay)
+
+    s = pl.Simulation('test')
+    s.attrs['executable'] = str(executable)
+    s.append(pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 0]]))
+    s.append(pl.evolve(1000))
+    return s
+
+
+def test_thermo(monkeypatch, tmp_path, fakelammps, capsys):
+    monkeypatch.chdir(tmp_path)
+    s = _asyncsimulation(fakelammps, 0)
+    s.attrs['timestep'] = 1e-9
+
+    updates = []
+    s.execute(progress=updates.append, quiet=True)
+    out = capsys.readouterr().out
+    assert 'Created' not in out and 'Loop time' not in out
+
+    assert s.thermo.dtype.names == ('step', 'cpu')
+    assert list(s.thermo.step) == [0, 250, 500, 750, 1000]
+    assert [u['progress'] for u in updates] == [0, 0.25, 0.5, 0.75, 1]
+    assert updates[0]['steps_per_second'] is None
+    assert updates[1]['steps_per_second'] == pytest.approx(1e4)
+    assert updates[1]['ns_per_day'] == pytest.approx(8.64e8)
+    assert updates[1]['eta'] == pytest.approx(0.075)
+    assert s.attrs['performance']['steps_per_second'] == pytest.approx(1e4)
+
+    with h5py.File('test.h5', 'r') as f:
+        assert list(f['thermo']['step']) == [0, 250, 500, 750, 1000]
+
+
+def test_thermovariables(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    s = pl.Simulation('test')
+    s.attrs['thermo'] = {'every': 100, 'variables': ['temp', 'pe']}
+    s.append(pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 0]]))
+    s._writeinputfile()
+
+    with open('test.lammps') as f:
+        script = f.read()
+    assert 'thermo 100\n' in script
+    assert 'thermo_style custom step cpu temp pe\n' in script
+
+    # lammps names the columns itself
+    s._startoutput()
+    s._parseline('   Step          CPU          Temp          PotEng')
+    s._parseline('       0            0             0    1.5e-20')
+    s._parseline('Loop time of 0.1 on 1 procs for 0 steps')
+    s._finishoutput()
+    assert s.thermo.dtype.names == ('step', 'cpu', 'temp', 'pe')
+    assert s.thermo.pe[0] == 1.5e-20
+
+
+def test_thermoincomplete():
+    s = pl.Simulation('test')
+    assert s.thermo is None and s.timing is None
+    s.append({'code': ['variable n equal 100', 'run ${n}']})
+
+    # runs with their steps in variables have no known total, and lammps
+    # can stop right after the header
+    s._startoutput()
+    assert s._steps == 0
+    s._parseline('   Step          CPU')
+    s._finishoutput()
+    assert s.thermo is None and s.runstats is None
+
+
+_TIMING = """Loop time of 0.5 on 1 procs for 1000 steps with 2 atoms
+
+Performance: 1728.000 ns/day, 0.014 hours/ns, 2000.000 timesteps/s
+99.8% CPU use with 1 MPI tasks x 1 OpenMP threads
+
+MPI task timing breakdown:
+Section |  min time  |  avg time  |  max time  |%varavg| %CPU | %total
+-----------------------------------------------------------------------
+Pair    | 0.1        | 0.1        | 0.1        |   0.0 | 99.9 | 20.00
+Neigh   | 0          | 0          | 0          |   0.0 |  0.0 |  0.00
+Comm    | 0.01       | 0.01       | 0.01       |   0.0 | 99.0 |  2.00
+Output  | 0.01       | 0.01       | 0.01       |   0.0 | 99.0 |  2.00
+Modify  | {modify}   | {modify}   | {modify}   |   0.0 | 99.9 | 60.00
+Other   |            | 0.08       |            |       |      | 16.00
+
+Nlocal:              2 ave           2 max           2 min
+Histogram: 1 0 0 0 0 0 0 0 0 0
+Nghost:              0 ave           0 max           0 min
+Histogram: 1 0 0 0 0 0 0 0 0 0
+Neighs:              1 ave           1 max           1 min
+Histogram: 1 0 0 0 0 0 0 0 0 0
+
+Total # of neighbors = 1
+Ave neighs/atom = 0.5
+Neighbor list builds = 0
+Dangerous builds = 0
+"""
+
+
+def test_timing(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    s = pl.Simulation('test')
+    s.append(pl.placeions({'mass': 40, 'charge': 1},
+                          [[0, 0, 0], [1e-4, 0, 0]]))
+    bath = pl.langevinbath(0, 1e-5)
+    s.append(bath)
+    s.append(pl.evolve(1000))
+    s.remove(bath)
+    s.append(pl.evolve(1000))
+    s._writeinputfile()
+
+    with open('test.lammps') as f:
+        assert 'timer full\n' in f.read()
+
+    s._startoutput()
+    for modify in [0.3, 0.1]:
+        for line in _TIMING.format(modify=modify).splitlines():
+            assert s._parseline(line) == line
+    s._finishoutput()
+
+    assert list(s.runstats.steps) == [1000, 1000]
+    assert list(s.runstats.neighbors) == [1, 1]
+    assert s.runstats.nlocal[0] == 2
+
+    assert len(s.timing) == 12
+    modify = s.timing[s.timing.section == b'Modify']
+    assert list(modify.avg) == [0.3, 0.1]
+    assert list(modify.cpu) == [99.9, 99.9]
+    other = s.timing[s.timing.section == b'Other'][0]
+    assert np.isnan(other['min']) and other.avg == 0.08
+
+    # the bath only ran in the first run
+    fixes = [set(s.activefixes.fix[s.activefixes.run == run])
+             for run in [0, 1]]
+    uid = str(bath['uid']).encode()
+    assert uid in fixes[0] and uid not in fixes[1]
+    assert b'timeIntegrator' in fixes[0] & fixes[1]
+    style = s.activefixes.style[s.activefixes.fix == uid]
+    assert list(style) == [b'langevin']
+
+
+def test_executeasync(monkeypatch, tmp_path, fakelammps):
+    monkeypatch.chdir(tmp_path)
+    s = _asyncsimulation(fakelammps, 0)
+
+    async def main():
+        run = await s.execute_async()
+        lines, progress = [], []
+        async for line in run:
+            lines.append(line)
+            progress.append(run.progress)
+        return lines, progress, await run.wait()
+
+    lines, progress, h5file = asyncio.run(main())
+    assert lines[0] == 'Created 1 atoms.'
+    assert progress[-1] == 1
+    assert 0.25 in progress
+    assert h5file == 'test.h5' and os.path.exists(h5file)
+
+    with pytest.raises(SimulationError, match='executed already'):
+        asyncio.run(s.execute_async())
+
+
+def test_executeasync_cancel(monkeypatch, tmp_path, fakelammps):
+    monkeypatch.chdir(tmp_path)
+    s = _asyncsimulation(fakelammps, 10)
+
+    async def main():
+        run = await s.execute_async()
+        async for line in run:
+            if run.step == 250:
+                run.cancel()
+        await run.wait()
+        return run
+
+    run = asyncio.run(asyncio.wait_for(main(), 5))
+    assert run.progress == 0.25
+    assert run.process.returncode != 0
+
+
+def test_stableuids():
+    uid = pl.efield(1, 1, 1)['uid']
+    code = 'import pylion as pl; print(pl.efield(1, 1, 1)["uid"])'
+    for _ in range(2):
+        output = subprocess.run([sys.executable, '-c', code],
+                                capture_output=True, text=True).stdout
+        assert int(output) == uid
+
+    assert pl.efield(1, 1, 1.1)['uid'] != uid
+
+
+_COUNTRUNS = '''
+# counts its runs
+with open('{counter}', 'a') as f:
+    f.write('run\\n')
+'''
+
+
+def _cachedsimulation(executable, cache, radius=1e-4):
+    s = pl.Simulation('test')
+    s.attrs['executable'] = str(executable)
+    s.attrs['cache'] = cache
+    s.append(pl.placeions({'mass': 40, 'charge': 1}, [[radius, 0, 0]]))
+    s.append(pl.dump('positions.txt', ['x', 'y', 'z']))
+    s.append(pl.evolve(100))
+    return s
+
+
+def test_resultcache(monkeypatch, tmp_path, fakelammps):
+    monkeypatch.chdir(tmp_path)
+    counter = tmp_path / 'runs'
+    executable = fakelammps(_COUNTRUNS, counter=counter)
+    assert _lammpsversion(str(executable)) == (
+        '22 Jul 2025 - Update 4 (stable / stable_22Jul2025_update4)')
+    cache = {'directory': str(tmp_path / 'cache'), 'size': 2**20}
+
+    _cachedsimulation(executable, cache).execute()
+    os.remove('positions.txt')
+    os.remove('log.lammps')
+
+    # the second time lammps does not run but all files are there
+    _cachedsimulation(executable, cache).execute()
+    assert counter.read_text() == 'run\n'
+    assert open('positions.txt').read() == 'ITEM: TIMESTEP\n0\n'
+    with h5py.File('test.h5', 'r') as f:
+        assert 'positions.txt' in f and 'log.lammps' in f
+
+    # a different simulation runs again
+    _cachedsimulation(executable, cache, radius=2e-4).execute()
+    assert counter.read_text() == 'run\n' * 2
+    entries = pl.ResultCache(**cache).entries()
+    assert len(entries) == 2
+
+    # the least recently used entry goes first
+    size = entries[0][1]
+    resultcache = pl.ResultCache(cache['directory'], size=size)
+    resultcache.evict()
+    assert [key for key, _, _ in resultcache.entries()] == [entries[0][0]]
+
+
+_KEEPSCRIPTS = '''
+# keeps the scripts it runs and writes restart files like lammps would
+with open('{scripts}', 'a') as f:
+    f.write(script + '@@@')
+for words in lines:
+    if words[:1] == ['write_restart']:
+        open(words[1], 'w').write('restart')
+'''
+
+
+def test_prefixcache(monkeypatch, tmp_path, fakelammps):
+    monkeypatch.chdir(tmp_path)
+    scripts = tmp_path / 'scripts'
+    executable = fakelammps(_KEEPSCRIPTS, scripts=scripts)
+    cache = {'directory': str(tmp_path / 'cache'), 'prefixes': True}
+
+    def simulation(steps):
+        s = pl.Simulation('test')
+        s.attrs['executable'] = str(executable)
+        s.attrs['cache'] = cache
+        s.append(pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 0]]))
+        s.append(pl.langevinbath(0, 1e-5))
+        s.append(pl.evolve(1000))
+        s.append(pl.dump('positions.txt', ['x', 'y', 'z']))
+        s.append(pl.evolve(steps))
+        s.execute()
+        return s
+
+    # the first run has nothing to share, the second keeps a snapshot of
+    # the common prefix and the third starts from it
+    for steps in [10, 20, 30]:
+        s = simulation(steps)
+    first, second, third = scripts.read_text().split('@@@')[:3]
+
+    assert 'restart' not in first
+    assert 'run 1000\nwrite_restart test.restart\n' in second
+    assert 'read_restart' not in second
+
+    assert 'read_restart' in third and 'write_restart' not in third
+    assert 'create_box' not in third and 'create_atoms' not in third
+    assert 'run 1000' not in third and 'run 30' in third
+    assert 'fix' in third and 'langevin' in third
+    assert s.attrs['prefix']['read'] == 2
+    with h5py.File('test.h5', 'r') as f:
+        assert 'test.prefix.lammps' in f
+
+
+_RESTARTS = '''
+# runs, dumps and writes restart files like lammps would and crashes at the
+# step in the crash file
+crash = int(open('crash').read()) if os.path.exists('crash') else None
+step, every, dumps, last = 0, None, {{}}, {{}}
+for words in lines:
+    if not words:
+        continue
+    elif words[0] == 'log':
+        open(words[1], 'a').close()
+    elif words[0] == 'restart':
+        every, pattern = int(words[1]), words[2]
+    elif words[0] == 'read_restart':
+        try:
+            step = int(open(words[1]).read())
+        except ValueError:
+            print('ERROR: Incomplete or corrupted LAMMPS restart file')
+            sys.exit(1)
+    elif words[0] == 'dump':
+        dumps[words[1]] = [words[5], int(words[4]), 'w']
+    elif words[0] == 'dump_modify':
+        dumps[words[1]][2] = 'a'
+    elif words[0] == 'run':
+        end = int(words[1]) if 'upto' in words else step + int(words[1])
+        print('Step CPU', flush=True)
+        for s in range(step, end + 1):
+            if s % 100 == 0 or s == end:
+                print(f'{{s}} 0.0', flush=True)
+            for uid, (filename, n, mode) in dumps.items():
+                if s % n == 0 and last.get(uid) != s:
+                    with open(filename, mode) as f:
+                        f.write(f'ITEM: TIMESTEP\\n{{s}}\\n')
+                    dumps[uid][2], last[uid] = 'a', s
+            if every and s > step and s % every == 0:
+                open(pattern.replace('*', str(s)), 'w').write(str(s))
+            if s == crash:
+                os.remove('crash')
+                sys.exit(1)
+        print(f'Loop time of 0.1 on 1 procs for {{end - step}} steps')
+        step = end
+'''
+
+
+@pytest.mark.parametrize('truncated', [False, True])
+def test_resume(truncated, monkeypatch, tmp_path, fakelammps):
+    monkeypatch.chdir(tmp_path)
+    executable = fakelammps(_RESTARTS)
+
+    def simulation():
+        s = pl.Simulation('test')
+        s.attrs['executable'] = str(executable)
+        s.attrs['checkpoint'] = {'every': 300}
+        s.append(pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 0]]))
+        s.append(pl.dump('positions.txt', ['x', 'y', 'z'], steps=100))
+        s.append(pl.evolve(1000))
+        s.append(pl.thermalvelocities(1e-3))
+        s.append(pl.evolve(500))
+        return s
+
+    (tmp_path / 'crash').write_text('1250')
+    simulation().execute()
+    assert json.loads((tmp_path / 'test.checkpoint.json').read_text()) == [
+        1000]
+    # the restart files are pruned after lammps stopped too
+    assert sorted(f for f in os.listdir() if f.endswith('.restart')) == [
+        'test.1200.restart', 'test.900.restart']
+
+    # a restart file that lammps cannot read is passed over
+    if truncated:
+        (tmp_path / 'test.1200.restart').write_text('')
+    s = simulation()
+    s.resume()
+    script = (tmp_path / 'test.resume.lammps').read_text()
+    restart = 'test.900.restart' if truncated else 'test.1200.restart'
+    assert f'read_restart {restart}' in script
+    assert 'create_atoms' not in script
+    if truncated:
+        # the first run had not finished by then
+        assert 'run 1000 upto' in script and 'run 500\n' in script
+    else:
+        assert 'velocity' not in script and 'run 1000\n' not in script
+        assert 'run 1500 upto' in script
+    assert 'append yes' in script
+
+    # the dump goes on from the checkpoint without repeated frames
+    steps = [int(line) for line in open('positions.txt')
+             if line.strip().isdigit()]
+    assert steps == list(range(0, 1501, 100))
+    with h5py.File('test.h5', 'r') as f:
+        assert 'test.resume.lammps' in f
+
+    with pytest.raises(SimulationError, match='finished'):
+        simulation().resume()
+
+
+class _FakeRestartLammps(_FakeLammps):
+    # writes a restart file every 300 steps of the runs
+    step = 0
+
+    def command(self, line):
+        super().command(line)
+        words = line.split()
+        if words[0] == 'run':
+            for step in range(self.step + 1, self.step + int(words[1]) + 1):
+                if step % 300 == 0:
+                    open(f'test.{step}.restart', 'w').close()
+            self.step += int(words[1])
+
+    def extract_global(self, name):
+        return self.step
+
+
+def test_librarycheckpoints(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    lmp = _FakeRestartLammps(['-log', 'log.lammps'])
+    module = type(sys)('lammps')
+    module.lammps = lambda cmdargs: lmp
+    monkeypatch.setitem(sys.modules, 'lammps', module)
+
+    s = pl.Simulation('test')
+    s.attrs['backend'] = 'library'
+    s.attrs['checkpoint'] = {'every': 300}
+    s.append(pl.placeions({'mass': 40, 'charge': 1}, [[0, 0, 0]]))
+    s.append(pl.evolve(1000))
+    s.append(pl.evolve(1000))
+    s.execute()
+
+    # only the two latest restart files are kept
+    assert json.loads((tmp_path / 'test.checkpoint.json').read_text()) == [
+        1000, 2000]
+    assert sorted(f for f in os.listdir() if f.endswith('.restart')) == [
+        'test.1500.restart', 'test.1800.restart']
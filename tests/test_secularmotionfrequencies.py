@@ -50,7 +50,8 @@ def simulation(simulation_data, request):
 
     yield s.attrs['timestep'], q
 
-    filenames = ['log.lammps', f'{name}.h5', f'{name}.lammps', 'positions.txt']
+    filenames = ['log.lammps', f'{name}.h5', f'{name}.lammps',
+                 f'{name}.data', 'positions.txt']
     for filename in filenames:
         os.remove(filename)
 